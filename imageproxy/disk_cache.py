@@ -0,0 +1,122 @@
+import os
+import tempfile
+import threading
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+# Eviction frees some room below max size so that it does not run again on
+# each following insert
+EVICTION_RATIO = 0.9
+
+
+class DiskCache(object):
+    """Content-addressed image cache shared by all processes using directory
+
+    Each entry is stored in its own file containing the content type on the
+    first line followed by the image data. Files are written atomically so
+    concurrent workers never read a partial entry.
+
+    The cache size is tracked in memory from a first scan of the directory
+    and the directory is only scanned again once this size exceeds max_size,
+    which also accounts for entries written by other processes.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__size = sum(x[1] for x in self.__get_entries())
+
+    def get(self, key):
+        path = self.__get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                content_type = f.readline()
+                content = f.read()
+
+            # Refresh modification time so eviction removes the least
+            # recently used entries first
+            os.utime(path)
+        except OSError:
+            return None
+
+        if not content_type.endswith(b'\n'):
+            return None
+
+        try:
+            return (content, content_type[:-1].decode())
+        except ValueError:
+            return None
+
+    def set(self, key, value):
+        content, content_type = value
+        path = self.__get_path(key)
+        existed = os.path.exists(path)
+        fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content_type.encode() + b'\n')
+                f.write(content)
+                size = f.tell()
+            os.replace(temppath, path)
+        except PermissionError:
+            # Windows cannot replace a file opened by a reader, the entry has
+            # the same content as its key is the content hash
+            self.__remove(temppath)
+            if not os.path.exists(path):
+                raise
+            return
+        except OSError:
+            self.__remove(temppath)
+            raise
+
+        with self.__lock:
+            if not existed:
+                self.__size += size
+            if self.__size > self.max_size:
+                self.__evict()
+
+    def clear(self):
+        with self.__lock:
+            for path, size, mtime in self.__get_entries():
+                self.__remove(path)
+            self.__size = sum(x[1] for x in self.__get_entries())
+
+    def __get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def __get_entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def __evict(self):
+        entries = self.__get_entries()
+        size = sum(x[1] for x in entries)
+        limit = self.max_size * EVICTION_RATIO
+
+        for path, entry_size, mtime in sorted(entries, key=lambda x: x[2]):
+            if size <= limit:
+                break
+            if self.__remove(path):
+                size -= entry_size
+
+        self.__size = size
+
+    def __remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # Entries opened by a reader cannot be removed on Windows
+            return False
+
+        return True
@@ -1,33 +1,85 @@
-from flask import Flask, request, make_response
-from werkzeug.contrib.cache import SimpleCache
+import hmac
+import os
+import re
+import tempfile
+
+from flask import Flask, request, make_response, abort
 import wand.image
-from utils.imageproxy import decode
+from imageproxy.disk_cache import DiskCache, DEFAULT_MAX_SIZE
+from utils.imageproxy import decode, content_hash
 
 CACHE_RETENTION = 24 * 60 * 60
-cache = SimpleCache()
+CACHE_DIR = os.environ.get(
+    'IMAGEPROXY_CACHE_DIR',
+    os.path.join(tempfile.gettempdir(), 'atlassianbot-imageproxy'))
+CACHE_MAX_SIZE = int(os.environ.get('IMAGEPROXY_CACHE_SIZE', DEFAULT_MAX_SIZE))
+cache = DiskCache(CACHE_DIR, CACHE_MAX_SIZE)
+CACHEKEY_REGEX = re.compile(r'^[0-9a-f]{64}$')
+# Uploads are refused unless this token is sent as a Bearer authorization
+UPLOAD_TOKEN = os.environ.get('IMAGEPROXY_UPLOAD_TOKEN')
 
 app = Flask(__name__)
 app.debug = False
+app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+
+
+@app.route('/upload', methods=['POST'])
+def register():
+    authorization = request.headers.get('Authorization', '')
+    if not UPLOAD_TOKEN or not hmac.compare_digest(
+            authorization, 'Bearer {}'.format(UPLOAD_TOKEN)):
+        abort(403)
+
+    content = request.get_data()
+    content_type = request.content_type
+    if not content or not content_type:
+        abort(400)
+
+    cachekey = content_hash(content_type, content)
+    if cache.get(cachekey) is None:
+        cache.set(cachekey, __convert(content, content_type))
+
+    response = make_response(cachekey, 201)
+    response.content_type = 'text/plain'
+    return response
+
+
+@app.route('/image/<cachekey>', methods=['GET'])
+def get(cachekey):
+    if not CACHEKEY_REGEX.match(cachekey):
+        abort(404)
+
+    cachevalue = cache.get(cachekey)
+    if cachevalue is None:
+        abort(404)
+
+    return __make_image_response(*cachevalue)
 
 
 @app.route('/image/<content_type>/<content>', methods=['GET'])
 def convert(content_type, content):
-    cachekey = request.path
+    content = decode(content)
+    content_type = decode(content_type).decode()
+    cachekey = content_hash(content_type, content)
 
     cachevalue = cache.get(cachekey)
 
     if cachevalue is None:
-        content = decode(content)
-        content_type = decode(content_type).decode()
-        if content_type.startswith('image/svg+xml'):
-            content = __svg2png(content)
-            content_type = 'image/png'
+        cachevalue = __convert(content, content_type)
+        cache.set(cachekey, cachevalue)
+
+    return __make_image_response(*cachevalue)
+
+
+def __convert(content, content_type):
+    if content_type.startswith('image/svg+xml'):
+        content = __svg2png(content)
+        content_type = 'image/png'
+
+    return (content, content_type)
 
-        cache.set(cachekey, (content, content_type), timeout=CACHE_RETENTION)
-    else:
-        content = cachevalue[0]
-        content_type = cachevalue[1]
 
+def __make_image_response(content, content_type):
     response = make_response(content)
     response.content_type = content_type
     response.cache_control.max_age = CACHE_RETENTION
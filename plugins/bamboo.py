@@ -2,17 +2,30 @@
 
 import re
 import requests
+import threading
+import time
+from concurrent.futures import Future
 
 from slackbot.bot import respond_to
 
 from . import settings
 import utils.rest as rest
+from utils.dispatcher import dispatched
+
+QUEUE_SNAPSHOT_TTL = 5  # seconds
 
 
 class BambooBot(object):
     def __init__(self, server, prefixes):
         self.__server = server
         self.__prefixes = prefixes
+        self.__snapshot_ttl = server.get('queue_snapshot_ttl',
+                                         QUEUE_SNAPSHOT_TTL)
+        self.__snapshot = None
+        self.__snapshot_expiration = 0
+        self.__snapshot_flight = None
+        self.__snapshot_generation = 0
+        self.__snapshot_lock = threading.Lock()
 
     def get_pattern(self):
         bamboo_prefixes = '|'.join(self.__prefixes)
@@ -28,7 +41,8 @@ class BambooBot(object):
             return
         else:
             message.reply_webapi('Yes my lord. I\'m looking for deployment plan to move...')
-            moved = self.__move_top(key, 'DEPLOYMENT')
+            moved = self.__move(key, 'DEPLOYMENT')
+            self.__invalidate_snapshot()
             if moved:
                 message.reply_webapi('Moved deployment {}'.format(deploymentid))
             else:
@@ -41,14 +55,30 @@ class BambooBot(object):
 
         message.reply_webapi('Yes my lord. I\'m looking for jobs to move...')
 
-        builds = self.__get_builds()
-        if builds is not None:
-            resultkeys = list(self.__find_matching_builds(builds, plankey))
+        snapshot = self.__get_snapshot()
+        if snapshot is not None:
+            resultkeys = self.__find_matching_builds(snapshot, plankey)
             if resultkeys:
-                for resultkey, index in resultkeys[::-1]:
-                    self.__move_top(resultkey, 'BUILD')
-
-                message.reply_webapi('Moved {} jobs'.format(len(resultkeys)))
+                start = time.monotonic()
+                try:
+                    moved, failed = self.__move_builds(snapshot, resultkeys)
+                finally:
+                    self.__invalidate_snapshot()
+
+                # Single read of the queue once all jobs are moved
+                snapshot = self.__get_snapshot(fresh=True)
+                verified = snapshot is None or \
+                    self.__is_queue_head(snapshot, resultkeys)
+
+                text = 'Moved {} jobs'.format(moved)
+                if failed:
+                    text += ', {} failed'.format(failed)
+                message.reply_webapi('{} in {:.1f}s'.format(
+                    text, time.monotonic() - start))
+                if not verified:
+                    message.reply_webapi(
+                        'Queue changed, jobs of {} are not on top anymore'
+                        .format(plankey))
             else:
                 message.reply_webapi('Plan {} not found in queue'
                                      .format(plankey))
@@ -56,13 +86,45 @@ class BambooBot(object):
             message.reply_webapi(
                 'I\'m not a Bamboo administrator and cannot move jobs')
 
-    def __move_top(self, resultkey, type):
+    def __move_builds(self, snapshot, resultkeys):
+        """Put resultkeys on top of the queue and return moved and failed
+        counts
+
+        Jobs already in place are not moved. Each job is then moved after
+        the previous one so the requests are sent back to back without
+        reading the queue again.
+        """
+        queue = snapshot.queue
+        placed = 0
+        while placed < len(resultkeys) and placed < len(queue) and \
+                queue[placed] == resultkeys[placed]:
+            placed += 1
+
+        moved = 0
+        failed = 0
+        prevresultkey = resultkeys[placed - 1] if placed else ''
+        for resultkey in resultkeys[placed:]:
+            if self.__move(resultkey, 'BUILD', prevresultkey):
+                moved += 1
+                prevresultkey = resultkey
+            else:
+                failed += 1
+
+        return moved, failed
+
+    def __is_queue_head(self, snapshot, resultkeys):
+        # Jobs started meanwhile are not in the queue anymore
+        queued = set(snapshot.queue)
+        expected = [x for x in resultkeys if x in queued]
+        return snapshot.queue[:len(expected)] == expected
+
+    def __move(self, resultkey, type, prevresultkey=''):
         request = rest.post(
             self.__server,
             '/build/admin/ajax/reorderBuild.action',
             data={
                 'resultKey': resultkey,
-                'prevResultKey': '',
+                'prevResultKey': prevresultkey,
                 'itemType': type
             }
         )
@@ -139,11 +201,62 @@ class BambooBot(object):
         elif request.status_code != requests.codes.ok:
             request.raise_for_status()
 
-    def __find_matching_builds(self, builds, plankey):
-        for build in builds:
-            if build['status'] == 'QUEUED' and 'planKey' in build\
-                    and build['planKey'].lower() == plankey.lower():
-                yield (build['resultKey'], build['queueIndex'])
+    def __find_matching_builds(self, snapshot, plankey):
+        return snapshot.plans.get(plankey.lower(), [])
+
+    def __get_snapshot(self, fresh=False):
+        """Return the queue snapshot, None if not a Bamboo administrator
+
+        Concurrent callers share the same dashboard request. A fresh
+        snapshot does not reuse the cached or in-flight one.
+        """
+        with self.__snapshot_lock:
+            flight = None
+            if not fresh:
+                if self.__snapshot is not None and \
+                        self.__snapshot_expiration > time.monotonic():
+                    return self.__snapshot
+
+                flight = self.__snapshot_flight
+
+            if flight is None:
+                owner = True
+                flight = Future()
+                if not fresh:
+                    self.__snapshot_flight = flight
+                generation = self.__snapshot_generation
+            else:
+                owner = False
+
+        if not owner:
+            return flight.result()
+
+        try:
+            builds = self.__get_builds()
+            snapshot = QueueSnapshot(builds) if builds is not None else None
+        except Exception as ex:
+            flight.set_exception(ex)
+            raise
+        finally:
+            with self.__snapshot_lock:
+                if self.__snapshot_flight is flight:
+                    self.__snapshot_flight = None
+
+        with self.__snapshot_lock:
+            # Queue read before a move is not cached
+            if snapshot is not None and \
+                    generation == self.__snapshot_generation:
+                self.__snapshot = snapshot
+                self.__snapshot_expiration = \
+                    time.monotonic() + self.__snapshot_ttl
+
+        flight.set_result(snapshot)
+        return snapshot
+
+    def __invalidate_snapshot(self):
+        with self.__snapshot_lock:
+            self.__snapshot = None
+            self.__snapshot_generation += 1
 
     def __get_builds(self):
         request = rest.get(
@@ -157,11 +270,26 @@ class BambooBot(object):
         return None
 
 
+class QueueSnapshot(object):
+    """Builds of the dashboard summary with queued jobs indexed by plan"""
+
+    def __init__(self, builds):
+        queued = sorted((x for x in builds if x['status'] == 'QUEUED'),
+                        key=lambda x: x['queueIndex'])
+        self.queue = [x['resultKey'] for x in queued]
+        self.plans = {}
+        for build in queued:
+            if 'planKey' in build:
+                self.plans.setdefault(build['planKey'].lower(), []).append(
+                    build['resultKey'])
+
+
 instance = BambooBot(settings.servers.bamboo,
                      settings.plugins.bamboobot.prefixes)
 
 if (settings.plugins.bamboobot.enabled):
     @respond_to(instance.get_pattern(), re.IGNORECASE)
+    @dispatched('bamboobot', settings.plugins.get('dispatch', {}))
     def bamboobot(message, plankey, other):
         result = re.search(instance.get_pattern(), message.body['text'], re.IGNORECASE)
 
@@ -4,6 +4,8 @@ import re
 import json
 import os
 import fnmatch
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from datetime import datetime, timedelta
 from shutil import rmtree
 
@@ -14,10 +16,15 @@ from . import crucible
 from . import bamboo
 from . import stash
 from . import settings
+from utils.dispatcher import dispatched
 
 
 class CleanBot(object):
     PENDING_ACTIONS_VALIDITY = 30  # seconds
+    SEARCH_TIMEOUT = 60  # seconds
+    # Commands wait behind searches of previous ones on a single worker
+    DISPATCH_MAX_AGE = 10 * 60  # seconds
+    SEARCH_WORKERS = 10
     __pending_actions = {}
 
     def __init__(self, settings, jira, bamboo, crucible, stash):
@@ -26,6 +33,7 @@ class CleanBot(object):
         self.__bamboo = bamboo
         self.__crucible = crucible
         self.__stash = stash
+        self.__executor = ThreadPoolExecutor(max_workers=self.SEARCH_WORKERS)
 
     def get_pattern(self):
         jira_prefixes = '|'.join(self.__jira.get_prefixes())
@@ -39,13 +47,14 @@ class CleanBot(object):
 
         username = self._get_username(message)
 
-        results = [
-            self.__search_jira(key, username),
-            self.__search_crucible(key),
-            self.__search_git(key),
-            self.__search_bamboo(key),
-            self.__search_folders(key),
+        searches = [
+            ('JIRA', lambda: self.__search_jira(key, username)),
+            ('CRUCIBLE', lambda: self.__search_crucible(key)),
+            ('STASH', lambda: self.__search_git(key)),
+            ('BAMBOO', lambda: self.__search_bamboo(key)),
+            ('FOLDERS', lambda: self.__search_folders(key)),
         ]
+        results = self.__run_searches(searches)
 
         messages = [y for x in results for y in x.messages]
         has_error = False
@@ -57,6 +66,7 @@ class CleanBot(object):
             message.reply_webapi('There are errors. Clean cannot be performed')
         else:
             actions = [y for x in results for y in x.actions]
+            checks = [y for x in results for y in x.checks]
             if len(actions) > 0:
                 message.reply_webapi(
                     'Send \'CLEAN YES\' to validate these changes')
@@ -64,7 +74,8 @@ class CleanBot(object):
                 self.__pending_actions[message._get_user_id()] = {
                     'date': datetime.utcnow(),
                     'key': key,
-                    'actions': actions
+                    'actions': actions,
+                    'checks': checks
                 }
             else:
                 message.reply_webapi('Nothing to clean')
@@ -90,6 +101,13 @@ class CleanBot(object):
                      'You have {} seconds to validate the action.')
                     .format(result['key'], self.PENDING_ACTIONS_VALIDITY))
             else:
+                errors = [x for x in (y() for y in result['checks']) if x]
+                if errors:
+                    message.reply_webapi(
+                        'Clean of {} aborted: {}'
+                        .format(result['key'], ' '.join(errors)))
+                    return
+
                 message.reply_webapi('Yes my lord. I\'m on it.')
                 for action in result['actions']:
                     action()
@@ -98,6 +116,27 @@ class CleanBot(object):
         else:
             message.reply_webapi('No pending action found')
 
+    def __run_searches(self, searches):
+        timeout = self.__settings.get('timeout', self.SEARCH_TIMEOUT)
+        deadline = time.monotonic() + timeout
+
+        futures = [(category, self.__executor.submit(search))
+                   for category, search in searches]
+
+        results = []
+        for category, future in futures:
+            try:
+                remaining = max(deadline - time.monotonic(), 0)
+                results.append(future.result(timeout=remaining))
+            except TimeoutError:
+                result = SearchResult(category)
+                result.add_error_message(
+                    'Search did not complete within {} seconds.'
+                    .format(timeout))
+                results.append(result)
+
+        return results
+
     def __search_jira(self, key, username):
         result = SearchResult('JIRA')
         status = self.__jira.get_issue_status(key)
@@ -126,7 +165,7 @@ class CleanBot(object):
 
     def __search_crucible(self, key):
         result = SearchResult('CRUCIBLE')
-        reviews = self.__crucible.get_reviews_from_jira(key)
+        reviews = self.__crucible.get_indexed_reviews_from_jira(key)
         if len(reviews) == 0:
             result.add_message('No linked reviews found.', None)
         else:
@@ -139,38 +178,47 @@ class CleanBot(object):
             if not result.has_error:
                 result.add_message('All linked reviews are closed.', None)
 
+        # Reviews may come from the index, they are requested again before
+        # cleaning
+        result.add_check(lambda k=key: self.__check_crucible(k))
         return result
 
+    def __check_crucible(self, key):
+        reviews = self.__crucible.get_reviews_from_jira(key)
+        opened = [x['permaId']['id'] for x in reviews
+                  if x['state'] != 'Closed' and x['state'] != 'Dead']
+        if opened:
+            return 'Review {} is not closed.'.format(', '.join(opened))
+
     def __search_git(self, key):
         result = SearchResult('STASH')
-        branches = self.__stash.get_stash_branches(
+        branches = self.__stash.get_branches_merge_status(
                          self.__settings['stash']['repos'],
                          self.__settings['stash']['project'],
-                         key)
-        if len(branches) == 0:
+                         key,
+                         self.__settings['stash']['basebranches'])
+        found = False
+        for repo, branchkey, branchname, changeset, merged in branches:
+            found = True
+            if merged:
+                result.add_message(
+                            'Git branch {} {} will be removed.'
+                            .format(repo, branchname))
+                result.add_action(
+                    lambda r=repo, b=branchkey, c=changeset:
+                        self.__stash.remove_git_branches(
+                            self.__settings['stash']['project'],
+                            r,
+                            b,
+                            c)
+                )
+            else:
+                result.add_error_message(
+                            'Git branch {} {} is not merged.'
+                            .format(repo, branchname))
+
+        if not found:
             result.add_message('No linked Git branch to remove.', None)
-        else:
-            for repo, branchkey, branchname, changeset in branches:
-                if self.__stash.branch_merged(
-                        self.__settings['stash']['project'],
-                        self.__settings['stash']['basebranches'],
-                        repo,
-                        branchkey):
-                    result.add_message(
-                                'Git branch {} {} will be removed.'
-                                .format(repo, branchname))
-                    result.add_action(
-                        lambda r=repo, b=branchkey, c=changeset:
-                            self.__stash.remove_git_branches(
-                                self.__settings['stash']['project'],
-                                r,
-                                b,
-                                c)
-                    )
-                else:
-                    result.add_error_message(
-                                'Git branch {} {} is not merged.'
-                                .format(repo, branchname))
 
         return result
 
@@ -232,6 +280,7 @@ class CleanBot(object):
 class SearchResult(object):
     def __init__(self, category):
         self.__actions = []
+        self.__checks = []
         self.__messages = []
         self.__error = False
         self.__category = category
@@ -239,6 +288,10 @@ class SearchResult(object):
     def add_action(self, action):
         self.__actions.append(action)
 
+    def add_check(self, check):
+        """Add a function returning an error if actions must be cancelled"""
+        self.__checks.append(check)
+
     def add_message_formatted(self, message):
         self.__messages.append(message)
 
@@ -260,6 +313,10 @@ class SearchResult(object):
     def actions(self):
         return self.__actions
 
+    @property
+    def checks(self):
+        return self.__checks
+
     @property
     def messages(self):
         return self.__messages
@@ -287,10 +344,14 @@ instance = CleanBot(settings.plugins.cleanbot.searches,
                     stash.Stash(settings.servers.stash))
 
 if (settings.plugins.cleanbot.enabled):
+    # A single worker keeps CLEAN YES after the search it confirms
     @respond_to(instance.get_pattern(), re.IGNORECASE)
+    @dispatched('cleanbot', settings.plugins.get('dispatch', {}), workers=1,
+                max_age=CleanBot.DISPATCH_MAX_AGE)
     def cleanbot_generate_tasks(message, key):
         instance.generate_clean_tasks(message, key)
 
     @respond_to('CLEAN YES', re.IGNORECASE)
+    @dispatched('cleanbot')
     def cleanbot_execute_tasks(message):
         instance.execute_clean_tasks(message)
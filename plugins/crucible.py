@@ -1,24 +1,51 @@
 # coding: utf-8
 
-import re
 import json
+import logging
 import requests
-from itertools import filterfalse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from slackbot.bot import listen_to
 from slackbot.bot import respond_to
 
 from . import settings
 import utils.rest as rest
+from utils.dispatcher import dispatched
+from utils.key_matcher import KeyMatcher, TRIGGER_PATTERN, shared_matcher
 from utils.messages_cache import MessagesCache
 
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 8
+REVIEWS_INDEX_REFRESH = 300  # seconds
+REVIEWS_INDEX_OVERLAP = 60000  # ms, covers clock skew with the server
+REVIEWS_INDEX_HISTORY = 365  # days
+REVIEWS_INDEX_BATCH = 30  # days
+CLOSED_REVIEW_STATES = ('Closed', 'Dead')
+
 
 class CrucibleBot(object):
-    def __init__(self, cache, server, prefixes):
+    def __init__(self, cache, server, prefixes, matcher=None,
+                 max_workers=None):
         self.__cache = cache
         self.__server = server
         self.__prefixes = prefixes
-        self.__crucible_regex = re.compile(self.get_pattern(), re.IGNORECASE)
+
+        if max_workers is None:
+            max_workers = server.get('max_workers', MAX_WORKERS)
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.__index = ReviewsIndex(
+            server,
+            server.get('reviews_index_refresh', REVIEWS_INDEX_REFRESH),
+            server.get('reviews_index_projects'),
+            server.get('reviews_index_history', REVIEWS_INDEX_HISTORY))
+
+        if matcher is None:
+            matcher = KeyMatcher()
+        matcher.register('crucible', prefixes)
+        self.__matcher = matcher
 
     def get_pattern(self):
         crucible_prefixes = '|'.join(self.__prefixes)
@@ -26,18 +53,23 @@ class CrucibleBot(object):
             .format(crucible_prefixes)
 
     def display_reviews(self, message):
-        def filter_predicate(x):
-            return self.__cache.IsInCache(self.__get_cachekey(x, message))
-
-        reviews = self.__crucible_regex.findall(message.body['text'])
-        reviews = filterfalse(filter_predicate, reviews)
+        reviews = self.__matcher.findall('crucible', message.body['text'])
+        reviews = [x for x in reviews
+                   if self.__cache.add_if_absent(
+                       self.__get_cachekey(x, message))]
         if reviews:
-            attachments = []
-            for reviewid in filterfalse(filter_predicate, reviews):
-                self.__cache.AddToCache(self.__get_cachekey(reviewid, message))
+            # Reviews are all requested at once, each one followed by its
+            # uncompleted reviewers when it is found
+            futures = [(reviewid,
+                        self.__executor.submit(
+                            self.__get_review_with_reviewers, reviewid))
+                       for reviewid in reviews]
 
+            attachments = []
+            for reviewid, future in futures:
                 try:
-                    msg = self.__get_review_message(reviewid)
+                    msg = self.__get_review_message(reviewid,
+                                                    *future.result())
                     if msg is None:
                         msg = self.__get_reviewnotfound_message(reviewid)
 
@@ -61,8 +93,21 @@ class CrucibleBot(object):
         else:
             request.raise_for_status()
 
-    def __get_review_message(self, reviewid):
-        review = self.__get_review(reviewid)
+    def get_indexed_reviews_from_jira(self, jirakey):
+        """Return reviews linked to jirakey, from the index when possible
+
+        Only keys with reviews, all closed, are answered from memory as it
+        is a final state, others are requested again.
+        """
+        reviews = self.__index.get(jirakey)
+        if not reviews or not all(
+                x['state'] in CLOSED_REVIEW_STATES for x in reviews):
+            reviews = self.get_reviews_from_jira(jirakey)
+            self.__index.set(jirakey, reviews)
+
+        return reviews
+
+    def __get_review_message(self, reviewid, review, reviewers):
         if review:
             reviewurl = '{}/cru/{}'.format(
                    self.__server['host'],
@@ -83,14 +128,13 @@ class CrucibleBot(object):
                 'fields': [],
             }
 
-            uncompleted_reviewers = self.__get_uncompleted_reviewers(reviewid)
-            if uncompleted_reviewers:
+            if reviewers:
                 attachment['fallback'] = attachment['fallback'] + \
                     '\nUncompleted reviewers: {}'.format(
-                    ', '.join(uncompleted_reviewers))
+                    ', '.join(reviewers))
                 attachment['fields'].append({
                     'title': 'Uncompleted reviewers',
-                    'value': ' '.join(uncompleted_reviewers),
+                    'value': ' '.join(reviewers),
                     'short': False
                 })
             return attachment
@@ -103,6 +147,13 @@ class CrucibleBot(object):
             'color': 'warning'
         }
 
+    def __get_review_with_reviewers(self, reviewid):
+        review = self.__get_review(reviewid)
+        if review is None:
+            return (None, None)
+
+        return (review, self.__get_uncompleted_reviewers(reviewid))
+
     def __get_review(self, reviewid):
         request = rest.get(
             self.__server,
@@ -125,13 +176,134 @@ class CrucibleBot(object):
         return reviewId + message.body['channel']
 
 
+class ReviewsIndex(object):
+    """Crucible reviews (permaId and state) indexed by linked Jira key
+
+    Reviews created during the last history days are loaded in background
+    on first use, by batches of REVIEWS_INDEX_BATCH days and only for the
+    given projects if any. Reviews are then requested again from the date
+    of the previous refresh every refresh_interval seconds. Keys are not
+    answered until the first load is done. The index is disabled when
+    refresh_interval is 0.
+    """
+
+    def __init__(self, server, refresh_interval=REVIEWS_INDEX_REFRESH,
+                 projects=None, history=REVIEWS_INDEX_HISTORY):
+        self.refresh_interval = refresh_interval
+        self.projects = projects
+        self.history = history
+        self.__server = server
+        self.__reviews = {}
+        self.__lock = threading.Lock()
+        self.__refresh_lock = threading.Lock()
+        self.__refreshed = None  # server date (ms) of the last refresh
+        self.__next_refresh = 0
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__reviews)
+
+    def get(self, jirakey):
+        """Return indexed reviews of jirakey, None if they are unknown"""
+        if not self.refresh_interval:
+            return None
+
+        self.__refresh_if_due()
+        with self.__lock:
+            if self.__refreshed is None:
+                return None
+
+            reviews = self.__reviews.get(jirakey.upper())
+            return list(reviews.values()) if reviews is not None else None
+
+    def set(self, jirakey, reviews):
+        """Replace all reviews of jirakey"""
+        if not self.refresh_interval:
+            return
+
+        with self.__lock:
+            self.__reviews[jirakey.upper()] = {
+                x['permaId']['id']: _get_indexed_review(x) for x in reviews}
+
+    def refresh(self):
+        self.__next_refresh = time.monotonic() + self.refresh_interval
+        started = int(time.time() * 1000)
+        if self.__refreshed is not None:
+            self.__add(self.__search(
+                self.__refreshed - REVIEWS_INDEX_OVERLAP))
+        else:
+            # Most recent reviews first, each batch is a short request
+            batch = REVIEWS_INDEX_BATCH * 24 * 60 * 60 * 1000
+            oldest = started - self.history * 24 * 60 * 60 * 1000
+            to_date = started
+            while to_date > oldest:
+                from_date = max(to_date - batch, oldest)
+                self.__add(self.__search(from_date, to_date))
+                to_date = from_date
+
+        with self.__lock:
+            self.__refreshed = started
+
+    def __search(self, from_date, to_date=None):
+        reviews = []
+        for project in self.projects or [None]:
+            params = {'fromDate': from_date}
+            if to_date is not None:
+                params['toDate'] = to_date
+            if project is not None:
+                params['project'] = project
+
+            request = rest.get(
+                self.__server,
+                '/rest-service/reviews-v1/filter',
+                params)
+            request.raise_for_status()
+            reviews.extend(request.json()['reviewData'])
+
+        return reviews
+
+    def __add(self, reviews):
+        with self.__lock:
+            for review in reviews:
+                jirakey = review.get('jiraIssueKey')
+                if jirakey:
+                    self.__reviews.setdefault(jirakey.upper(), {})[
+                        review['permaId']['id']] = _get_indexed_review(review)
+
+    def __refresh_if_due(self):
+        # Only one thread refreshes in background, others use the current
+        # index or the live search meanwhile
+        if time.monotonic() < self.__next_refresh or \
+                not self.__refresh_lock.acquire(blocking=False):
+            return
+
+        self.__next_refresh = time.monotonic() + self.refresh_interval
+        threading.Thread(target=self.__run_refresh,
+                         name='crucible-reviews-index',
+                         daemon=True).start()
+
+    def __run_refresh(self):
+        try:
+            self.refresh()
+        except (requests.exceptions.RequestException, ValueError) as ex:
+            logger.error('Unable to refresh Crucible reviews index: %s', ex)
+        finally:
+            self.__refresh_lock.release()
+
+
+def _get_indexed_review(review):
+    return {'permaId': review['permaId'], 'state': review['state']}
+
+
 instance = CrucibleBot(MessagesCache(),
                        settings.servers.crucible,
-                       settings.plugins.cruciblebot.prefixes)
+                       settings.plugins.cruciblebot.prefixes,
+                       matcher=shared_matcher)
 
 
 if (settings.plugins.cruciblebot.enabled):
-    @listen_to(instance.get_pattern(), re.IGNORECASE)
-    @respond_to(instance.get_pattern(), re.IGNORECASE)
-    def cruciblebot(message, _):
+    @listen_to(TRIGGER_PATTERN)
+    @respond_to(TRIGGER_PATTERN)
+    @dispatched('cruciblebot', settings.plugins.get('dispatch', {}))
+    def cruciblebot(message):
         instance.display_reviews(message)
@@ -1,10 +1,9 @@
 # coding: utf-8
 
 import inspect
-import re
+import threading
 import json
 import logging
-from itertools import filterfalse
 
 import arrow
 from jira import JIRA
@@ -12,22 +11,38 @@ from jira.exceptions import JIRAError
 from lazy import lazy
 
 from slackbot.bot import Bot, listen_to, respond_to
+from werkzeug.serving import make_server
 
 from . import settings
+from utils.checkpoint_store import CheckpointStore
+from utils.dispatcher import dispatched
 from utils.messages_cache import MessagesCache
+from webhook.flask_app import create_app as create_webhook_app
 from utils.imageproxy import convert_proxyurl
+from utils.key_matcher import KeyMatcher, TRIGGER_PATTERN, shared_matcher
 from utils.notifier_bot import NotifierBot, NotifierJob
+from utils.metrics import instrument
+from utils.rest import get_backend
+from utils.ttl_cache import TTLCache
 logger = logging.getLogger(__name__)
 
-MAX_NOTIFIERS_WORKERS = 2
+ISSUE_FIELDS = 'summary,issuetype,status'
+SEARCH_PAGE_SIZE = 50
+ISSUES_CACHE_SIZE = 1000
+ISSUES_CACHE_RETENTION = 5 * 60
+NOTIFIER_TIMEOUT = 30  # seconds
+NOTIFIER_FIELDS = 'summary,customfield_10012,updated,issuetype,assignee'
+NOTIFIED_RETENTION = 60 * 60
+# Search results include the whole changelog of each issue
+NOTIFIER_PAGE_SIZE = 20
 
 
-def get_Jira_instance(server):
+def get_Jira_instance(server, timeout=None):
     auth = None
     if 'username' in server and 'password' in server:
         auth = (server['username'], server['password'])
 
-    return JIRA(
+    jira = JIRA(
         options={
             'server': server['host'],
             'verify': settings.servers.verify_ssl},
@@ -36,13 +51,27 @@ def get_Jira_instance(server):
         max_retries=1
     )
 
+    instrument(jira._session, get_backend(server), timeout)
+
+    return jira
+
 
 class JiraBot(object):
-    def __init__(self, cache, server, prefixes):
+    def __init__(self, cache, server, prefixes, issues_cache=None,
+                 matcher=None):
         self.__cache = cache
         self.__server = server
         self.__prefixes = prefixes
-        self.__jira_regex = re.compile(self.get_pattern(), re.IGNORECASE)
+
+        # Keys following CLEAN are commands handled by the CleanBot
+        if matcher is None:
+            matcher = KeyMatcher()
+        matcher.register('jira', prefixes, ignored_before=['CLEAN'])
+        self.__matcher = matcher
+
+        if issues_cache is None:
+            issues_cache = TTLCache(ISSUES_CACHE_SIZE, ISSUES_CACHE_RETENTION)
+        self.__issues_cache = issues_cache
 
     @lazy
     def __jira(self):
@@ -56,10 +85,13 @@ class JiraBot(object):
     def get_prefixes(self):
         return self.__prefixes
 
+    @property
+    def issues_cache(self):
+        return self.__issues_cache
+
     def get_issue_status(self, key):
         try:
-            issue = self.__jira.issue(key, fields='status')
-            return issue.fields.status.name
+            return self.__get_issue(key)['status']
         except JIRAError:
             return None
 
@@ -83,47 +115,122 @@ class JiraBot(object):
                 assignee={'name': user}
             )
 
+        self.__issues_cache.remove(key.upper())
+
     def display_issues(self, message):
-        attachments = []
+        issues = self.__matcher.findall('jira', message.body['text'])
 
-        issues = self.__jira_regex.findall(message.body['text'])
+        keys = [x for x in issues
+                if self.__cache.add_if_absent(self.__get_cachekey(x, message))]
 
-        def filter_predicate(x):
-            return self.__cache.IsInCache(self.__get_cachekey(x, message))
+        if keys:
+            attachments = self.get_issues_messages(keys)
+            message.send_webapi('', json.dumps(attachments))
 
-        for issue in filterfalse(filter_predicate, issues):
-            self.__cache.AddToCache(self.__get_cachekey(issue, message))
-            issue_message = self.get_issue_message(issue)
-            if issue_message is None:
-                issue_message = self.__get_issuenotfound_message(issue)
+    def get_issues_messages(self, keys):
+        issues = {}
+        missing_keys = []
+        for key in keys:
+            issue = self.__issues_cache.get(key.upper())
+            if issue is None:
+                missing_keys.append(key)
+            else:
+                issues[key.upper()] = issue
 
-            attachments.append(issue_message)
+        if missing_keys:
+            try:
+                results = list(self.__search_issues(missing_keys))
+            except JIRAError as ex:
+                error_message = self.__get_error_message(ex)
+                if error_message is not None:
+                    return [error_message]
+                results = []
 
-        if attachments:
-            message.send_webapi('', json.dumps(attachments))
+            for result in results:
+                issue = self.__cache_issue(result)
+                issues[issue['key'].upper()] = issue
+
+        attachments = []
+        for key in keys:
+            issue = issues.get(key.upper())
+            if issue is None:
+                attachments.append(self.__get_issuenotfound_message(key))
+            else:
+                attachments.append(self.__format_issue_message(issue))
+
+        return attachments
+
+    def __search_issues(self, keys):
+        """Search keys by chunks of the search page size
+
+        Jira caps maxResults on the server so each chunk is also paged
+        until all its issues are returned.
+        """
+        page_size = self.__server.get('search_page_size', SEARCH_PAGE_SIZE)
+        for index in range(0, len(keys), page_size):
+            chunk = keys[index:index + page_size]
+            # Unknown keys are ignored by Jira when query validation is
+            # disabled
+            query = 'key in ({})'.format(','.join(chunk))
+            start = 0
+            while True:
+                results = self.__jira.search_issues(
+                                query,
+                                startAt=start,
+                                maxResults=len(chunk),
+                                validate_query=False,
+                                fields=ISSUE_FIELDS)
+                yield from results
+
+                start += len(results)
+                if len(results) == 0 or start >= results.total:
+                    break
 
     def get_issue_message(self, key):
         try:
-            issue = self.__jira.issue(key, fields='summary,issuetype')
-            icon = convert_proxyurl(
-                                    self.__server['imageproxy'],
-                                    issue.fields.issuetype.iconUrl)
-            summary = issue.fields.summary.encode('utf8')
-            return {
-                'fallback': '{key} - {summary}\n{url}'.format(
-                    key=issue.key,
-                    summary=summary.decode(),
-                    url=issue.permalink()
-                    ),
-                'author_name': issue.key,
-                'author_link': issue.permalink(),
-                'author_icon': icon,
-                'text': summary.decode(),
-                'color': '#59afe1'
-            }
+            return self.__format_issue_message(self.__get_issue(key))
         except JIRAError as ex:
             return self.__get_error_message(ex)
 
+    def __get_issue(self, key):
+        issue = self.__issues_cache.get(key.upper())
+        if issue is None:
+            issue = self.__cache_issue(
+                self.__jira.issue(key, fields=ISSUE_FIELDS))
+
+        return issue
+
+    def __cache_issue(self, issue):
+        details = {
+            'key': issue.key,
+            'link': issue.permalink(),
+            'summary': issue.fields.summary,
+            'issuetype': issue.fields.issuetype.name,
+            'status': issue.fields.status.name,
+            'icon': convert_proxyurl(
+                                     self.__server['imageproxy'],
+                                     issue.fields.issuetype.iconUrl,
+                                     self.__server.get('imageproxy_upload',
+                                                       False),
+                                     self.__server.get('imageproxy_token'))
+        }
+        self.__issues_cache.set(issue.key.upper(), details)
+        return details
+
+    def __format_issue_message(self, issue):
+        return {
+            'fallback': '{key} - {summary}\n{url}'.format(
+                key=issue['key'],
+                summary=issue['summary'],
+                url=issue['link']
+                ),
+            'author_name': issue['key'],
+            'author_link': issue['link'],
+            'author_icon': issue['icon'],
+            'text': issue['summary'],
+            'color': '#59afe1'
+        }
+
     def __get_issuenotfound_message(self, key):
         return {
             'fallback': 'Issue {key} not found'.format(key=key),
@@ -146,75 +253,145 @@ class JiraBot(object):
 
 class JiraNotifierBot(NotifierBot):
     def __init__(self, server, config, slackclient=None):
-        super().__init__(slackclient)
+        super().__init__(slackclient, config)
 
         self.__server = server
+        self.__timeout = config.get('timeout', NOTIFIER_TIMEOUT)
+        self.__checkpoints = CheckpointStore(config.get('checkpoint_file'))
         self._jobs = list(self.submit_jobs(config))
 
+        self.__webhook_server = None
+        webhook = config.get('webhook', {})
+        if webhook.get('enabled', False) and self.executor is not None:
+            self.__start_webhook(webhook)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.__webhook_server is not None:
+            self.__webhook_server.shutdown()
+        super().__exit__(exc_type, exc_value, traceback)
+
     def submit_jobs(self, config):
+        jobs = []
         for notifier_settings in config['notifiers']:
             logger.info('registered JiraNotifierBot for query \'%s\' '
                         'on channel \'#%s\'',
                         notifier_settings['query'],
                         notifier_settings['channel'])
-            job = JiraNotifierJob(
+            jobs.append(JiraNotifierJob(
                                   self.__jira,
                                   self.__server['imageproxy'],
                                   notifier_settings,
-                                  config['polling_interval'])
-            self.submit(job)
-            yield job
+                                  config['polling_interval'],
+                                  self.__server.get('imageproxy_upload',
+                                                    False),
+                                  self.__checkpoints,
+                                  self.__server.get('imageproxy_token')))
+
+        if config.get('combined', False) and len(jobs) > 1:
+            # All queries are polled with a single search and matching
+            # issues are dispatched to each notifier
+            self.submit(JiraCombinedNotifierJob(self.__jira,
+                                                jobs,
+                                                config['polling_interval'],
+                                                self.__checkpoints))
+        else:
+            for job in jobs:
+                self.submit(job)
+
+        return jobs
+
+    def notify_closed_issue(self, key):
+        """Send closed issue to each notifier whose query matches it"""
+        issue = self.__jira.issue(key,
+                                  fields=NOTIFIER_FIELDS,
+                                  expand='changelog')
+
+        for job in self._jobs:
+            if job.bound and \
+                    key in get_matching_keys(self.__jira, job.query, [key]):
+                job.notify([issue])
+
+    def __start_webhook(self, config):
+        if not config.get('token'):
+            logger.error('Jira webhook not started, a token is required')
+            return
+
+        # Webhooks deliver closed issues as soon as they are closed, polling
+        # keeps running to catch up missed webhooks
+        app = create_webhook_app(self.__on_closed_issue, config['token'])
+        self.__webhook_server = make_server(config.get('host', '0.0.0.0'),
+                                            config['port'],
+                                            app,
+                                            threaded=True)
+        threading.Thread(target=self.__webhook_server.serve_forever,
+                         daemon=True).start()
+        logger.info('registered Jira webhook on port %s', config['port'])
+
+    def __on_closed_issue(self, key):
+        future = self.executor.submit(self.notify_closed_issue, key)
+        future.add_done_callback(self.__log_webhook_error)
+
+    def __log_webhook_error(self, future):
+        if future.exception() is not None:
+            logger.error('Unable to notify closed issue: %s',
+                         future.exception())
 
     @lazy
     def __jira(self):
-        return get_Jira_instance(self.__server)
+        return get_Jira_instance(self.__server, self.__timeout)
 
 
 class JiraNotifierJob(NotifierJob):
-    def __init__(self, jira, imageproxy, config, polling_interval):
-        super().__init__(config['channel'], polling_interval)
+    def __init__(self, jira, imageproxy, config, polling_interval,
+                 imageproxy_upload=False, checkpoints=None,
+                 imageproxy_token=None):
+        super().__init__(config['channel'], polling_interval, backend='jira')
         self.__jira = jira
         self.__imageproxy = imageproxy
+        self.__imageproxy_upload = imageproxy_upload
+        self.__imageproxy_token = imageproxy_token
         self.__config = config
+        if checkpoints is None:
+            checkpoints = CheckpointStore()
+        self.__checkpoints = checkpoints
+        # Issues can be received from both webhooks and polling
+        self.__notified = MessagesCache(NOTIFIED_RETENTION)
 
-    def init(self):
-        # First query to retrieve last matching task
-        query = '{} AND status = Closed ORDER BY updated DESC'\
-            .format(self.__config['query'])
-
-        results = self.__jira.search_issues(query, maxResults=1)
+    @property
+    def query(self):
+        return self.__config['query']
 
-        if len(results) == 0:
-            logger.error('No initial issue found')
-            return
+    @property
+    def name(self):
+        return self.__config.get(
+            'name', '#{}: {}'.format(self.channel, self.query))
 
-        self.__last_result = results[0]
+    def init(self):
+        init_checkpoint(self.__jira, self.__checkpoints, self.name, self.query)
 
     def run(self):
         logger.info('run')
-        # Convert last issue update date
-        # to a compatible timestamp for Jira
-        date = arrow.get(self.__last_result.fields.updated)
-
-        last_update = (date.timestamp + 1) * 1000
-        query = '{} AND status CHANGED TO Closed DURING({}, NOW()) '\
-                'ORDER BY updated DESC'\
-            .format(self.__config['query'], last_update)
-
-        fields = 'summary,customfield_10012,updated,issuetype,assignee'
-        results = self.__jira.search_issues(
-                        query,
-                        fields=fields,
-                        expand='changelog')
+        for results in search_closed_issues(self.__jira,
+                                            self.__checkpoints,
+                                            self.name,
+                                            self.query):
+            self.notify(results)
+
+    def notify(self, results):
+        """Send a message for issues sorted by ascending update date"""
+        results = [issue for issue in results
+                   if self.__notified.add_if_absent(
+                       '{}:{}'.format(issue.key, issue.fields.updated))]
 
         if len(results) > 0:
-            self.__last_result = results[0]
             attachments = []
-            for issue in results[::-1]:
+            for issue in results:
                 summary = issue.fields.summary.encode('utf8')
                 icon = convert_proxyurl(
                                 self.__imageproxy,
-                                issue.fields.issuetype.iconUrl)
+                                issue.fields.issuetype.iconUrl,
+                                self.__imageproxy_upload,
+                                self.__imageproxy_token)
 
                 sps = self.__get_storypoints(issue)
                 sps = self.__formatvalue(sps)
@@ -296,16 +473,160 @@ class JiraNotifierJob(NotifierJob):
                 return id
 
 
+class JiraCombinedNotifierJob(NotifierJob):
+    """Poll the queries of several notifiers with a single search
+
+    Closed issues are first retrieved with the OR of all queries, then each
+    notifier query is restricted to the returned keys to find which
+    notifiers must be notified. These searches only run when the combined
+    search returned issues.
+
+    The search resumes from the oldest checkpoint of the notifiers, which
+    are all moved to the combined checkpoint after each run, so combined
+    mode can be switched on or off without skipping issues.
+    """
+
+    def __init__(self, jira, jobs, polling_interval, checkpoints=None):
+        super().__init__(', '.join(job.channel for job in jobs),
+                         polling_interval,
+                         backend='jira')
+        self.__jira = jira
+        self.__jobs = jobs
+        self.__query = '({})'.format(
+            ' OR '.join('({})'.format(job.query) for job in jobs))
+        if checkpoints is None:
+            checkpoints = CheckpointStore()
+        self.__checkpoints = checkpoints
+        self.name = 'combined: {}'.format(self.__query)
+
+    def _bind(self, slackclient):
+        self.__jobs = [job for job in self.__jobs if job._bind(slackclient)]
+        return len(self.__jobs) > 0
+
+    def init(self):
+        checkpoints = [self.__checkpoints.get(job.name)
+                       for job in self.__jobs]
+        checkpoints = [x for x in checkpoints if x is not None]
+        if checkpoints:
+            oldest = min(checkpoints,
+                         key=lambda x: _get_timestamp(x['updated']))
+            self.__checkpoints.set(self.name, oldest['updated'], oldest['key'])
+
+        init_checkpoint(self.__jira,
+                        self.__checkpoints,
+                        self.name,
+                        self.__query)
+
+    def run(self):
+        logger.info('run')
+        for results in search_closed_issues(self.__jira,
+                                            self.__checkpoints,
+                                            self.name,
+                                            self.__query):
+            keys = [issue.key for issue in results]
+            for job in self.__jobs:
+                matches = get_matching_keys(self.__jira, job.query, keys)
+                job.notify([x for x in results if x.key in matches])
+
+        checkpoint = self.__checkpoints.get(self.name)
+        if checkpoint is not None:
+            for job in self.__jobs:
+                self.__checkpoints.set(job.name,
+                                       checkpoint['updated'],
+                                       checkpoint['key'])
+
+
+def init_checkpoint(jira, checkpoints, name, query):
+    checkpoint = checkpoints.get(name)
+    if checkpoint is not None:
+        logger.info('resume notifier \'%s\' after %s',
+                    name, checkpoint['key'])
+        return
+
+    # First query to retrieve last matching task
+    query = '{} AND status = Closed ORDER BY updated DESC'.format(query)
+
+    results = jira.search_issues(query, maxResults=1)
+
+    if len(results) == 0:
+        logger.error('No initial issue found')
+        return
+
+    checkpoints.set(name, results[0].fields.updated, results[0].key)
+
+
+def search_closed_issues(jira, checkpoints, name, query):
+    """Yield pages of issues closed since checkpoint, oldest first
+
+    Checkpoint is moved after each page so an interrupted catch up resumes
+    where it stopped. Each page is searched again from the checkpoint
+    instead of an offset as issues move to the end while they are updated.
+    Issues already returned within the checkpoint second are excluded.
+    """
+    checkpoint = checkpoints.get(name)
+    if checkpoint is None:
+        logger.error('No checkpoint for notifier \'%s\'', name)
+        return
+
+    since = _get_timestamp(checkpoint['updated'])
+    excluded = [checkpoint['key']]
+    while True:
+        # Jira dates are compared in milliseconds
+        page_query = '{} AND status CHANGED TO Closed DURING({}, NOW()) '\
+                     'AND key NOT IN ({}) ORDER BY updated ASC'\
+            .format(query, since * 1000, ','.join(excluded))
+
+        # Excluded issues may have been deleted meanwhile
+        results = jira.search_issues(page_query,
+                                     maxResults=NOTIFIER_PAGE_SIZE,
+                                     validate_query=False,
+                                     fields=NOTIFIER_FIELDS,
+                                     expand='changelog')
+        if len(results) == 0:
+            return
+
+        yield results
+
+        last_result = results[-1]
+        checkpoints.set(name, last_result.fields.updated, last_result.key)
+
+        last_update = _get_timestamp(last_result.fields.updated)
+        if last_update != since:
+            since = last_update
+            excluded = []
+        excluded.extend(
+            x.key for x in results
+            if _get_timestamp(x.fields.updated) == since)
+
+        if len(results) >= results.total:
+            return
+
+
+def _get_timestamp(updated):
+    return arrow.get(updated).timestamp
+
+
+def get_matching_keys(jira, query, keys):
+    query = 'key in ({}) AND ({})'.format(','.join(keys), query)
+    issues = jira.search_issues(query,
+                                maxResults=len(keys),
+                                validate_query=False,
+                                fields='key')
+    return set(issue.key for issue in issues)
+
+
 if (settings.plugins.jiranotifier.enabled):
     JiraNotifierBot(settings.servers.jira, settings.plugins.jiranotifier)
 
 instance = JiraBot(MessagesCache(),
                    settings.servers.jira,
-                   settings.plugins.jirabot.prefixes)
+                   settings.plugins.jirabot.prefixes,
+                   matcher=shared_matcher)
 
 
 if (settings.plugins.jirabot.enabled):
-    @listen_to(instance.get_pattern(), re.IGNORECASE)
-    @respond_to(instance.get_pattern(), re.IGNORECASE)
-    def jirabot(message, _):
+    @listen_to(TRIGGER_PATTERN)
+    @respond_to(TRIGGER_PATTERN)
+    @dispatched('jirabot', settings.plugins.get('dispatch', {}))
+    def jirabot(message):
         instance.display_issues(message)
@@ -0,0 +1,18 @@
+# coding: utf-8
+
+import logging
+
+from . import settings
+from utils.metrics import log_periodically, serve
+
+logger = logging.getLogger(__name__)
+
+config = settings.plugins.get('metrics', {})
+
+if config.get('enabled', False):
+    if config.get('port'):
+        serve(config['port'], config.get('host', '0.0.0.0'))
+        logger.info('serving metrics on port %s', config['port'])
+
+    if config.get('log_interval'):
+        log_periodically(config['log_interval'])
@@ -1,49 +1,82 @@
 # coding: utf-8
 
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import utils.rest as rest
 
+MAX_WORKERS = 8
+PAGE_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
 
 class Stash(object):
-    def __init__(self, server):
+    def __init__(self, server, max_workers=None):
+        if max_workers is None:
+            max_workers = server.get('max_workers', MAX_WORKERS)
+
         self.__server = server
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_stash_branches(self, repos, project, filter, max_pages=None):
+        return list(
+            self.iter_stash_branches(repos, project, filter, max_pages))
+
+    def iter_stash_branches(self, repos, project, filter, max_pages=None):
+        """Yield matching branches of all repos as pages are received
+
+        First page of every repo is requested immediately and each following
+        page is prefetched while the previous one is consumed.
+        """
+        data = {
+            'filterText': filter,
+            'details': True,
+            'limit': PAGE_SIZE
+        }
 
-    def get_stash_branches(self, repos, project, filter):
-        results = []
+        repos_pages = []
         for repo in repos:
             path = '/rest/api/1.0/projects/{project}/repos/{repo}/branches'\
                     .format(project=project, repo=repo)
-            data = {
-                'filterText': filter,
-                'details': True,
-                'limit': 100
-            }
-
-            request = rest.get(self.__server, path, data)
-            for result in request.json()['values']:
-                results.append((
+            repos_pages.append((repo, self.__paginate(path, data, max_pages)))
+
+        for repo, pages in repos_pages:
+            for result in pages:
+                yield (
                     repo,
                     result['id'],
                     result['displayId'],
-                    result['latestChangeset']))
+                    result['latestChangeset'])
+
+    def get_branches_merge_status(self, repos, project, filter, basebranches,
+                                  max_pages=None):
+        """Yield matching branches with a flag telling if they are merged
+
+        Each branch is compared to every base branch concurrently as soon
+        as it is listed and is merged once any base branch reports it so.
+        Results keep the listing order.
+        """
+        pending = deque()
+        branches = self.iter_stash_branches(repos, project, filter, max_pages)
+        for branch in branches:
+            repo, branchkey, branchname, changeset = branch
+            pending.append((branch, [
+                self.__executor.submit(
+                    self.__is_merged, project, repo, branchkey, to)
+                for to in basebranches]))
 
-        return results
+            while pending and self.__merge_status_ready(pending[0][1]):
+                yield self.__get_merge_status(*pending.popleft())
+
+        while pending:
+            yield self.__get_merge_status(*pending.popleft())
 
     def branch_merged(self, project, basebranches, repo, branch):
         for to in basebranches:
-            path = ('/rest/api/1.0/projects/{project}/repos/{repo}/'
-                    'compare/changes/').format(project=project, repo=repo)
-            data = {
-                'from': branch,
-                'to': to,
-                'limit': 1
-            }
-
-            request = rest.get(self.__server, path, data)
-            if request.status_code != 200:
-                raise Exception(request.text)
-            else:
-                if request.json()['size'] == 0:
-                    return True
+            if self.__is_merged(project, repo, branch, to):
+                return True
 
         return False
 
@@ -59,3 +92,70 @@ class Stash(object):
         request = rest.delete(self.__server, path, data)
         if request.status_code != 204:
             raise Exception(request.text)
+
+    def __paginate(self, path, data, max_pages):
+        future = self.__executor.submit(self.__get_page, path, data, 0)
+        return self.__iter_pages(future, path, data, max_pages)
+
+    def __iter_pages(self, future, path, data, max_pages):
+        count = 0
+        while future is not None:
+            page = future.result()
+            count += 1
+
+            future = None
+            if not page.get('isLastPage', True) and \
+                    (max_pages is None or count < max_pages):
+                future = self.__executor.submit(
+                    self.__get_page, path, data, page['nextPageStart'])
+
+            for value in page['values']:
+                yield value
+
+    def __get_page(self, path, data, start):
+        if start:
+            data = dict(data, start=start)
+
+        request = rest.get(self.__server, path, data)
+        if request.status_code != 200:
+            request.raise_for_status()
+
+        return request.json()
+
+    def __merge_status_ready(self, futures):
+        return all(f.done() for f in futures) or any(
+            f.done() and not f.exception() and f.result() for f in futures)
+
+    def __get_merge_status(self, branch, futures):
+        errors = []
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    break
+            except Exception as ex:
+                errors.append(ex)
+        else:
+            if errors:
+                raise errors[0]
+
+            return branch + (False,)
+
+        for ex in errors:
+            logger.warning('Unable to compare branch %s: %s', branch[2], ex)
+
+        return branch + (True,)
+
+    def __is_merged(self, project, repo, branch, to):
+        path = ('/rest/api/1.0/projects/{project}/repos/{repo}/'
+                'compare/changes/').format(project=project, repo=repo)
+        data = {
+            'from': branch,
+            'to': to,
+            'limit': 1
+        }
+
+        request = rest.get(self.__server, path, data)
+        if request.status_code != 200:
+            raise Exception(request.text)
+
+        return request.json()['size'] == 0
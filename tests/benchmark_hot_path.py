@@ -0,0 +1,249 @@
+"""Replay synthetic Slack messages through the plugins message handlers
+
+Servers are replaced by in-process responses so only the bot processing is
+measured. Results are saved as JSON to compare them between commits.
+
+Run with: python -m tests.benchmark_hot_path [--output FILE]
+"""
+import argparse
+import json
+import platform
+import random
+import re
+import subprocess
+import time
+from urllib.parse import parse_qs, urlparse
+
+import responses
+
+from plugins.bamboo import BambooBot
+from plugins.crucible import CrucibleBot
+from plugins.jira import JiraBot
+from utils.key_matcher import TRIGGER_PATTERN
+from utils.messages_cache import MessagesCache
+from .common import controlled_responses, get_message
+
+MESSAGES = 300
+MESSAGE_SIZES = {'short': 0, 'long': 4000}
+KEYS_COUNTS = [1, 5, 20]
+HIT_RATIOS = [0, 0.5, 0.9]
+
+JIRA_PREFIXES = ['JIRA', 'JIRB', 'PROJ', 'CORE', 'WEB']
+CRUCIBLE_PREFIXES = ['CRUA', 'CRUB']
+BAMBOO_PREFIXES = ['PLANA', 'PLANB']
+
+ICON_URL = 'http://host/images/icons/issuetypes/bug.gif'
+ICON = 'R0lGODlhAQABAIAAAP///wAAACH5BAEAAAAALAAAAAABAAEAAAICRAEAOw=='
+
+server = {
+    'host': 'http://host',
+    'username': 'user',
+    'password': 'pass',
+    'imageproxy': 'http://imageproxy'
+}
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'build', 'failed',
+         'ERROR', 'java.lang.NullPointerException', '-', '12:04:33']
+
+
+def get_text(rand, keys, size):
+    words = list(keys)
+    length = sum(len(x) + 1 for x in words)
+    while length < size:
+        word = rand.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+
+    rand.shuffle(words)
+    return ' '.join(words)
+
+
+def get_keys(rand, prefixes, count, hit_ratio, known_keys, counter):
+    keys = []
+    for _ in range(count):
+        if known_keys and rand.random() < hit_ratio:
+            keys.append(rand.choice(known_keys))
+        else:
+            counter[0] += 1
+            keys.append('{}-{}'.format(rand.choice(prefixes), counter[0]))
+    return keys
+
+
+def jira_search(request):
+    jql = parse_qs(urlparse(request.url).query)['jql'][0]
+    keys = re.search(r'key in \((.*)\)', jql).group(1).split(',')
+    issues = [{
+        'key': key.upper(),
+        'fields': {
+            'summary': 'Summary of {}'.format(key),
+            'issuetype': {'name': 'Bug', 'iconUrl': ICON_URL},
+            'status': {'name': 'Open'}
+        }
+    } for key in keys]
+    return (200, {}, json.dumps({'total': len(issues), 'issues': issues}))
+
+
+def crucible_review(request):
+    reviewid = request.url.rsplit('/', 1)[-1]
+    return (200, {}, json.dumps({
+        'permaId': {'id': reviewid},
+        'name': 'Review {}'.format(reviewid)
+    }))
+
+
+def crucible_reviewers(request):
+    return (200, {}, json.dumps({
+        'reviewer': [{'userName': 'user1'}, {'userName': 'user2'}]
+    }))
+
+
+def run_jira(rand, size, keys_count, hit_ratio):
+    bot = JiraBot(MessagesCache(), server, JIRA_PREFIXES)
+    known_keys = []
+    counter = [0]
+
+    # Fill issues cache so hit_ratio of keys are already known
+    warmup = get_keys(rand, JIRA_PREFIXES, 50, 0, known_keys, counter)
+    bot.get_issues_messages(warmup)
+    known_keys.extend(warmup)
+
+    def handle(index):
+        keys = get_keys(rand, JIRA_PREFIXES, keys_count, hit_ratio,
+                        known_keys, counter)
+        message = get_message(get_text(rand, keys, size),
+                              channel='channel{}'.format(index))
+        return lambda: dispatch(message, bot.display_issues)
+
+    return handle
+
+
+def run_crucible(rand, size, keys_count, hit_ratio):
+    bot = CrucibleBot(MessagesCache(), server, CRUCIBLE_PREFIXES)
+    known_keys = []
+    counter = [0]
+
+    def handle(index):
+        # Crucible only caches reviews already displayed on the channel
+        keys = get_keys(rand, CRUCIBLE_PREFIXES, keys_count, hit_ratio,
+                        known_keys, counter)
+        known_keys.extend(keys)
+        message = get_message(get_text(rand, keys, size))
+        return lambda: dispatch(message, bot.display_reviews)
+
+    return handle
+
+
+def run_bamboo(rand, size, keys_count, hit_ratio):
+    bot = BambooBot(server, BAMBOO_PREFIXES)
+
+    def handle(index):
+        plan = '{}-JOB{}'.format(rand.choice(BAMBOO_PREFIXES), index)
+        text = 'UP ' + get_text(rand, [plan], size)
+        return lambda: re.search(bot.get_pattern(), text, re.IGNORECASE)
+
+    return handle
+
+
+def dispatch(message, handler):
+    if re.search(TRIGGER_PATTERN, message.body['text']):
+        handler(message)
+
+
+def benchmark(runner, size, keys_count, hit_ratio, messages):
+    rand = random.Random(0)
+    with controlled_responses([{'url': ICON_URL,
+                                'code': 200,
+                                'text': ICON,
+                                'content_type': 'image/gif'}]) as rsps:
+        # Responses are reused by every message
+        rsps.rsps.assert_all_requests_are_fired = False
+        rsps.rsps.add_callback(
+            responses.GET,
+            re.compile(r'http://host/rest/api/2/search\?.+'),
+            callback=jira_search,
+            content_type='application/json')
+        rsps.rsps.add_callback(
+            responses.GET,
+            re.compile(r'http://host/rest-service/reviews-v1/[^/]+$'),
+            callback=crucible_review,
+            content_type='application/json')
+        rsps.rsps.add_callback(
+            responses.GET,
+            re.compile(r'http://host/rest-service/reviews-v1/.+/uncompleted'),
+            callback=crucible_reviewers,
+            content_type='application/json')
+
+        handle = runner(rand, size, keys_count, hit_ratio)
+        latencies = []
+        for index in range(messages):
+            function = handle(index)
+            start = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        'messages': messages,
+        'throughput': messages / sum(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def percentile(values, ratio):
+    return values[int(round(ratio * (len(values) - 1)))]
+
+
+def get_scenarios():
+    for size in MESSAGE_SIZES:
+        for keys_count in KEYS_COUNTS:
+            for hit_ratio in HIT_RATIOS:
+                yield ('jira', run_jira, size, keys_count, hit_ratio)
+                yield ('crucible', run_crucible, size, keys_count, hit_ratio)
+        yield ('bamboo', run_bamboo, size, 1, 0)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default='benchmark_hot_path.json')
+    parser.add_argument('--messages', type=int, default=MESSAGES)
+    args = parser.parse_args()
+
+    results = []
+    for plugin, runner, size, keys_count, hit_ratio in get_scenarios():
+        result = {
+            'plugin': plugin,
+            'size': size,
+            'keys': keys_count,
+            'hit_ratio': hit_ratio
+        }
+        result.update(benchmark(runner,
+                                MESSAGE_SIZES[size],
+                                keys_count,
+                                hit_ratio,
+                                args.messages))
+        results.append(result)
+        print('{plugin:<9}{size:<6}{keys:>3} keys {hit_ratio:>4.0%} hits '
+              '{throughput:>9.1f} msg/s  p50 {p50_ms:>7.3f} ms  '
+              'p99 {p99_ms:>7.3f} ms'.format(**result))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results
+        }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
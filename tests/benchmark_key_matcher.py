@@ -0,0 +1,78 @@
+"""Compare KeyMatcher with the plugins regexes
+
+Run with: python -m tests.benchmark_key_matcher
+"""
+import random
+import re
+import string
+import timeit
+
+from utils.key_matcher import KeyMatcher
+
+PREFIXES_COUNT = 300
+REPEAT = 5
+NUMBER = 20
+
+
+def get_prefixes(count):
+    rand = random.Random(0)
+    prefixes = set()
+    while len(prefixes) < count:
+        prefixes.add(''.join(rand.choice(string.ascii_uppercase)
+                             for _ in range(rand.randint(2, 8))))
+    return sorted(prefixes)
+
+
+def get_messages(prefixes):
+    rand = random.Random(1)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'at', '12:04:33',
+             'ERROR', 'java.lang.NullPointerException', '-', '--verbose']
+    log = '\n'.join(
+        ' '.join(rand.choice(words) for _ in range(12)) for _ in range(500))
+    return {
+        'short': 'Could you review {}-42 please?'.format(prefixes[0]),
+        'keys': ' '.join('{}-{}'.format(rand.choice(prefixes), x)
+                         for x in range(50)),
+        'log': log,
+        'log with key': log + ' {}-1'.format(prefixes[-1])
+    }
+
+
+def get_regexes(jira_prefixes, crucible_prefixes):
+    jira = r'(?:^|\s|[\W]+)(?<!CLEAN\s)((?:{})-[\d]+)(?:$|\s|[\W]+)'\
+        .format('|'.join(jira_prefixes))
+    crucible = r'(?:^|\s|[\W]+)((?:{})-[\d]+)(?:$|\s|[\W]+)'\
+        .format('|'.join(crucible_prefixes))
+    return [re.compile(jira, re.IGNORECASE),
+            re.compile(crucible, re.IGNORECASE)]
+
+
+def benchmark(function):
+    return min(timeit.repeat(function, repeat=REPEAT, number=NUMBER)) / NUMBER
+
+
+def main():
+    prefixes = get_prefixes(PREFIXES_COUNT)
+    jira_prefixes = prefixes[:PREFIXES_COUNT // 2]
+    crucible_prefixes = prefixes[PREFIXES_COUNT // 2:]
+
+    regexes = get_regexes(jira_prefixes, crucible_prefixes)
+    # Memoization is disabled to measure the scan itself
+    matcher = KeyMatcher(cache_size=0)
+    matcher.register('jira', jira_prefixes, ignored_before=['CLEAN'])
+    matcher.register('crucible', crucible_prefixes)
+
+    print('{:<14}{:>8}{:>14}{:>14}{:>9}'.format(
+        'message', 'length', 'regex (us)', 'matcher (us)', 'speedup'))
+    for name, text in get_messages(prefixes).items():
+        regex_time = benchmark(
+            lambda: [regex.findall(text) for regex in regexes])
+        matcher_time = benchmark(
+            lambda: [matcher.findall(x, text) for x in ('jira', 'crucible')])
+        print('{:<14}{:>8}{:>14.1f}{:>14.1f}{:>8.1f}x'.format(
+            name, len(text), regex_time * 1e6, matcher_time * 1e6,
+            regex_time / matcher_time))
+
+
+if __name__ == '__main__':
+    main()
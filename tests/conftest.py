@@ -0,0 +1,9 @@
+import pytest
+
+import utils.imageproxy
+
+
+@pytest.fixture(autouse=True)
+def icons_cache():
+    # Icons are cached for the whole process, reset them between tests
+    utils.imageproxy.clear_icons_cache()
@@ -2,6 +2,11 @@ import json
 import pytest
 import re
 import requests
+import responses
+import threading
+import time
+from itertools import count
+from mock import MagicMock
 from urllib.parse import parse_qs
 
 from .common import get_message, controlled_responses
@@ -75,16 +80,27 @@ def test_move_plan_planexist_exception(bot, testdata):
             bot.move_plan(msg, 'BAMA-DEV')
 
 
+def add_builds(rsps, builds):
+    rsps.rsps.add(
+        responses.GET,
+        'http://host/build/admin/ajax/getDashboardSummary.action',
+        body=json.dumps({'status': 'OK', 'builds': builds}),
+        content_type='application/json')
+
+
 @pytest.mark.parametrize('testdata', [
                         (data['move_plan_inqueue'])
                         ])
-def test_move_plan(bot, testdata):
+def test_move_plan(bot, testdata, monkeypatch):
+    clock = MagicMock(**{'monotonic.side_effect': count(10, 0.5)})
+    monkeypatch.setattr('plugins.bamboo.time', clock)
     with controlled_responses(testdata['requests'], server) as rsps:
         for x in range(0, len(testdata['post_result'])):
             rsps.add_post(
                 'http://host/build/admin/ajax/reorderBuild.action',
                 200,
                 {'status': 'OK'})
+        add_builds(rsps, testdata['final_builds'])
 
         msg = get_message()
         bot.move_plan(msg, 'BAMA-DEV')
@@ -104,6 +120,98 @@ def test_move_plan(bot, testdata):
         [msg.send_webapi.assert_any_call(x, attachments=None, as_user=True) for x in testdata['result']]
 
 
+def test_move_plan_partial(bot, monkeypatch):
+    clock = MagicMock(**{'monotonic.side_effect': count(10, 0.5)})
+    monkeypatch.setattr('plugins.bamboo.time', clock)
+    builds = [
+        {'status': 'QUEUED', 'resultKey': 'BAMA-DEV-JOB1-1',
+         'planKey': 'BAMA-DEV', 'queueIndex': 1},
+        {'status': 'QUEUED', 'resultKey': 'BAMX-DEV-JOB1-1',
+         'planKey': 'BAMX-DEV', 'queueIndex': 2},
+        {'status': 'QUEUED', 'resultKey': 'BAMA-DEV-JOB2-1',
+         'planKey': 'BAMA-DEV', 'queueIndex': 3},
+        {'status': 'QUEUED', 'resultKey': 'BAMA-DEV-JOB3-1',
+         'planKey': 'BAMA-DEV', 'queueIndex': 4}
+    ]
+    with controlled_responses(data['move_plan_inqueue']['requests'][:1],
+                              server) as rsps:
+        add_builds(rsps, builds)
+        rsps.add_post('http://host/build/admin/ajax/reorderBuild.action',
+                      200,
+                      {'status': 'ERROR', 'errors': ['Queue out of order']})
+        rsps.add_post('http://host/build/admin/ajax/reorderBuild.action',
+                      200,
+                      {'status': 'OK'})
+        add_builds(rsps, [builds[0], builds[3], builds[1], builds[2]])
+
+        msg = get_message()
+        bot.move_plan(msg, 'BAMA-DEV')
+
+        # JOB1 is already on top, JOB3 follows JOB1 as JOB2 was not moved
+        bodies = [parse_qs(x.request.body, keep_blank_values=True)
+                  for x in rsps.calls[2:4]]
+        assert [(x['resultKey'][0], x['prevResultKey'][0]) for x in bodies] \
+            == [('BAMA-DEV-JOB2-1', 'BAMA-DEV-JOB1-1'),
+                ('BAMA-DEV-JOB3-1', 'BAMA-DEV-JOB1-1')]
+
+        msg.send_webapi.assert_any_call(
+            'Moved 1 jobs, 1 failed in 1.0s', attachments=None, as_user=True)
+        msg.send_webapi.assert_any_call(
+            'Queue changed, jobs of BAMA-DEV are not on top anymore',
+            attachments=None, as_user=True)
+
+
+def test_queue_snapshot(bot):
+    builds = data['move_plan_inqueue']['final_builds']
+    started = threading.Event()
+    requested = []
+
+    def dashboard(request):
+        requested.append(request)
+        started.set()
+        # Let other threads wait on the in-flight request
+        time.sleep(0.2)
+        return (200, {}, json.dumps({'status': 'OK', 'builds': builds}))
+
+    get_snapshot = bot._BambooBot__get_snapshot
+    with controlled_responses() as rsps:
+        for _ in range(3):
+            rsps.rsps.add_callback(
+                responses.GET,
+                'http://host/build/admin/ajax/getDashboardSummary.action',
+                callback=dashboard)
+
+        snapshots = []
+        threads = [threading.Thread(
+            target=lambda: snapshots.append(get_snapshot()))
+            for _ in range(5)]
+        threads[0].start()
+        started.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(requested) == 1
+        assert all(x is snapshots[0] for x in snapshots)
+        assert get_snapshot() is snapshots[0]
+        assert snapshots[0].queue == \
+            ['BAMA-DEV-JOB1-1', 'BAMA-DEV-JOB2-1', 'BAMX-DEV-JOB1-1']
+        assert snapshots[0].plans['bama-dev'] == \
+            ['BAMA-DEV-JOB1-1', 'BAMA-DEV-JOB2-1']
+
+        # A fresh snapshot is always requested and replaces the cached one
+        fresh = get_snapshot(fresh=True)
+        assert len(requested) == 2
+        assert fresh is not snapshots[0]
+        assert get_snapshot() is fresh
+
+        # Moves invalidate the snapshot
+        bot._BambooBot__invalidate_snapshot()
+        assert get_snapshot() is not fresh
+        assert len(requested) == 3
+
+
 @pytest.mark.parametrize('testdata', [
     (data['move_deployment_inqueue'])
 ])
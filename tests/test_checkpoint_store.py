@@ -0,0 +1,37 @@
+import json
+import os
+
+from utils.checkpoint_store import CheckpointStore
+
+
+def test_memory_store():
+    store = CheckpointStore()
+    assert store.get('name') is None
+
+    store.set('name', '2015-07-21T11:44:45.000+0200', 'JIRA-1')
+    assert store.get('name') == {
+        'updated': '2015-07-21T11:44:45.000+0200',
+        'key': 'JIRA-1'
+    }
+
+
+def test_file_store(tmpdir):
+    path = str(tmpdir.join('checkpoints.json'))
+    store = CheckpointStore(path)
+    store.set('name', '2015-07-21T11:44:45.000+0200', 'JIRA-1')
+
+    with open(path) as f:
+        assert json.load(f) == {
+            'name': {'updated': '2015-07-21T11:44:45.000+0200',
+                     'key': 'JIRA-1'}
+        }
+    assert os.listdir(str(tmpdir)) == ['checkpoints.json']
+
+    assert CheckpointStore(path).get('name') == store.get('name')
+
+
+def test_invalid_file(tmpdir):
+    path = tmpdir.join('checkpoints.json')
+    path.write('invalid')
+
+    assert CheckpointStore(str(path)).get('name') is None
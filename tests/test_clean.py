@@ -1,6 +1,7 @@
 import pytest
 import json
 import re
+import time
 from mock import MagicMock
 
 from plugins.clean import CleanBot
@@ -30,6 +31,10 @@ def get_message_with_user(input):
 
 @pytest.fixture
 def bot():
+    return get_bot()
+
+
+def get_bot(**extra_settings):
     jira = test_jira.bot()
     bamboo = test_bamboo.bot()
     crucible = test_crucible.bot()
@@ -47,6 +52,7 @@ def bot():
         },
         'folders': []
     }]
+    settings[0].update(extra_settings)
     cleanbot = CleanBot(settings, jira, bamboo, crucible, stash)
     return cleanbot
 
@@ -116,3 +122,54 @@ def test_generate_clean_tasks(bot, input, testdata):
                 assert json.loads(kwargs['attachments']) == result
             else:
                 assert result == args[0]
+
+
+def test_generate_clean_tasks_timeout():
+    bot = get_bot(timeout=0.2)
+    testdata = data['cleanbot_canclean']
+    msg = get_message_with_user('JIRA-1')
+
+    def search_folders(key):
+        time.sleep(1)
+    bot._CleanBot__search_folders = search_folders
+
+    with controlled_responses(testdata['requests']):
+        bot.generate_clean_tasks(msg, 'JIRA-1')
+
+        args, kwargs = msg.send_webapi.call_args_list[1]
+        messages = json.loads(kwargs['attachments'])
+        assert messages[:-1] == testdata['result'][1][:-1]
+        assert messages[-1] == {
+            'author_name': 'FOLDERS',
+            'text': '*Search did not complete within 0.2 seconds.*',
+            'color': 'danger',
+            'mrkdwn_in': ['text']
+        }
+
+        args, kwargs = msg.send_webapi.call_args_list[2]
+        assert args[0] == 'There are errors. Clean cannot be performed'
+
+
+def test_execute_clean_tasks_review_reopened():
+    bot = get_bot(allowedusers=['username1'])
+    testdata = data['cleanbot_canclean']
+    msg = get_message_with_user('JIRA-1')
+    with controlled_responses(testdata['requests']):
+        bot.generate_clean_tasks(msg, 'JIRA-1')
+
+    # Reviews are requested again before executing any action
+    msg = get_message_with_user('CLEAN YES')
+    msg.body['user'] = 'id1'
+    msg._client.find_user_by_name = MagicMock(return_value='id1')
+    msg.reply_webapi = MagicMock()
+    with controlled_responses([{
+        'url': 'http://host/rest-service/search-v1/reviewsForIssue'
+               '?jiraKey=JIRA-1',
+        'code': 200,
+        'text': {'reviewData': [{'permaId': {'id': 'CRUA-1'},
+                                 'state': 'Review'}]}
+    }]):
+        bot.execute_clean_tasks(msg)
+
+    msg.reply_webapi.assert_called_once_with(
+        'Clean of JIRA-1 aborted: Review CRUA-1 is not closed.')
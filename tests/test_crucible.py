@@ -3,15 +3,20 @@ import json
 import pytest
 import re
 import requests
+import responses
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
 
 from .common import get_message, controlled_responses
-from plugins.crucible import CrucibleBot
+from plugins.crucible import CrucibleBot, ReviewsIndex, REVIEWS_INDEX_OVERLAP
 from utils.messages_cache import MessagesCache
 
 with open('tests/test_crucible_data.json') as data_file:
     data = json.load(data_file)
 
-server = {'host': 'http://host', 'username': 'user', 'password': 'pass'}
+server = {'host': 'http://host', 'username': 'user', 'password': 'pass',
+          'reviews_index_refresh': 0}
 userpass = server['username'] + ':' + server['password']
 userpass = base64.b64encode(userpass.encode()).decode()
 prefixes = ['CRUA', 'CRUB']
@@ -85,6 +90,16 @@ def test_messages_cache(bot, input, testdata):
         assert message.send_webapi.called
 
 
+def test_display_reviews_notfound_reviewers(bot):
+    testdata = data['display_reviews_CRUA-2']
+    with controlled_responses(testdata['requests'], server) as rsps:
+        bot.display_reviews(get_message('CRUA-2'))
+
+        # Reviewers of a missing review are not requested
+        assert [x.request.url for x in rsps.calls] == \
+            ['http://host/rest-service/reviews-v1/CRUA-2']
+
+
 @pytest.mark.parametrize('input,testdata', [
                          ('CRUA-3', data['display_reviews_CRUA-3-error1']),
                          ('CRUA-3', data['display_reviews_CRUA-3-error2']),
@@ -115,3 +130,176 @@ def test_get_reviews_from_jira_err(bot, jirakey, testdata):
     with controlled_responses(testdata['requests'], server):
         with pytest.raises(requests.exceptions.HTTPError):
             bot.get_reviews_from_jira(jirakey)
+
+
+def test_display_reviews_concurrent(bot):
+    # Reviews, then their reviewers, must be in flight at the same time to
+    # pass the barriers
+    barrier = threading.Barrier(2, timeout=5)
+    reviewers_barrier = threading.Barrier(2, timeout=5)
+
+    def review(request):
+        barrier.wait()
+        reviewid = request.url.rsplit('/', 1)[-1]
+        return (200, {}, json.dumps({'permaId': {'id': reviewid},
+                                     'name': reviewid + ' name'}))
+
+    def reviewers(request):
+        reviewers_barrier.wait()
+        return (200, {}, json.dumps({'reviewer': [{'userName': 'user1'}]}))
+
+    with controlled_responses() as rsps:
+        for reviewid in ['CRUA-1', 'CRUA-2']:
+            url = 'http://host/rest-service/reviews-v1/' + reviewid
+            rsps.rsps.add_callback(responses.GET, url, callback=review)
+            rsps.rsps.add_callback(responses.GET,
+                                   url + '/reviewers/uncompleted',
+                                   callback=reviewers)
+
+        message = get_message('CRUA-2 & CRUA-1')
+        bot.display_reviews(message)
+
+        args, kwargs = message.send_webapi.call_args
+        assert [x['author_name'] for x in json.loads(args[1])] == \
+            ['CRUA-2', 'CRUA-1']
+
+
+def get_review_data(reviewid, state, jirakey):
+    return {'permaId': {'id': reviewid}, 'state': state,
+            'jiraIssueKey': jirakey, 'name': reviewid + ' name'}
+
+
+def get_reviews_for_issue_request(jirakey, reviews):
+    return {
+        'url': 'http://host/rest-service/search-v1/reviewsForIssue'
+               '?jiraKey=' + jirakey,
+        'code': 200,
+        'text': {'reviewData': reviews}
+    }
+
+
+def test_get_indexed_reviews_from_jira():
+    bot = CrucibleBot(MessagesCache(),
+                      dict(server, reviews_index_refresh=300,
+                           reviews_index_history=30),
+                      prefixes)
+    release = threading.Event()
+
+    def search(request):
+        # Index is loaded in background, lookups don't wait for it
+        release.wait(5)
+        return (200, {}, json.dumps({'reviewData': [
+            get_review_data('CRUA-1', 'Closed', 'JIRAA-1'),
+            get_review_data('CRUA-2', 'Review', 'JIRAA-2'),
+            get_review_data('CRUA-3', 'Dead', 'JIRAA-1')
+        ]}))
+
+    with controlled_responses([
+        get_reviews_for_issue_request('JIRAA-1', []),
+        get_reviews_for_issue_request(
+            'JIRAA-2', [get_review_data('CRUA-2', 'Closed', None)]),
+        get_reviews_for_issue_request('JIRAA-3', []),
+        get_reviews_for_issue_request('JIRAA-3', [])
+    ], server) as rsps:
+        rsps.rsps.add_callback(responses.GET,
+                               'http://host/rest-service/reviews-v1/filter',
+                               callback=search)
+
+        assert bot.get_indexed_reviews_from_jira('JIRAA-1') == []
+        release.set()
+
+        index = bot._CrucibleBot__index
+        deadline = time.monotonic() + 5
+        while index.get('JIRAA-2') is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # Closed reviews are answered from the index
+        reviews = bot.get_indexed_reviews_from_jira('JIRAA-1')
+        assert sorted(x['permaId']['id'] for x in reviews) == \
+            ['CRUA-1', 'CRUA-3']
+
+        # Opened reviews and keys without reviews are requested again
+        for jirakey in ['JIRAA-2', 'JIRAA-2', 'JIRAA-3', 'JIRAA-3']:
+            bot.get_indexed_reviews_from_jira(jirakey)
+
+        assert [x.request.url.rsplit('=', 1)[-1] for x in rsps.calls
+                if 'reviewsForIssue' in x.request.url] == \
+            ['JIRAA-1', 'JIRAA-2', 'JIRAA-3', 'JIRAA-3']
+
+
+
+def test_get_indexed_reviews_from_jira_without_reviews():
+    bot = CrucibleBot(MessagesCache(),
+                      dict(server, reviews_index_refresh=300,
+                           reviews_index_history=0),
+                      prefixes)
+    index = bot._CrucibleBot__index
+    index.refresh()
+    index.set('JIRAA-1', [])
+
+    # A key without reviews may get new ones, it is not a final state
+    with controlled_responses([
+        get_reviews_for_issue_request('JIRAA-1', []),
+        get_reviews_for_issue_request(
+            'JIRAA-1', [get_review_data('CRUA-1', 'Review', None)])
+    ], server):
+        assert bot.get_indexed_reviews_from_jira('JIRAA-1') == []
+        reviews = bot.get_indexed_reviews_from_jira('JIRAA-1')
+
+    assert [x['permaId']['id'] for x in reviews] == ['CRUA-1']
+
+def test_reviews_index_refresh():
+    index = ReviewsIndex(server, projects=['CR', 'CS'], history=45)
+    queries = []
+
+    def search(request):
+        queries.append(parse_qs(urlparse(request.url).query))
+        reviews = []
+        if len(queries) == 1:
+            reviews = [get_review_data('CRUA-1', 'Review', 'JIRAA-1')]
+        elif len(queries) == 5:
+            reviews = [get_review_data('CRUA-1', 'Closed', 'JIRAA-1'),
+                       get_review_data('CRUA-2', 'Review', 'jiraa-1')]
+        return (200, {}, json.dumps({'reviewData': reviews}))
+
+    with controlled_responses() as rsps:
+        for _ in range(6):
+            rsps.rsps.add_callback(
+                responses.GET,
+                'http://host/rest-service/reviews-v1/filter',
+                callback=search)
+
+        start = int(time.time() * 1000)
+        index.refresh()
+        assert index.get('JIRAA-2') is None
+        assert index.get('JIRAA-1') == [
+            {'permaId': {'id': 'CRUA-1'}, 'state': 'Review'}]
+
+        # Only the last 45 days are loaded, by batches of 30 days
+        day = 24 * 60 * 60 * 1000
+        assert [x['project'] for x in queries] == \
+            [['CR'], ['CS'], ['CR'], ['CS']]
+        batches = [(int(x['fromDate'][0]), int(x['toDate'][0]))
+                   for x in queries[::2]]
+        assert batches[0][1] - batches[0][0] == 30 * day
+        assert batches[0][0] == batches[1][1]
+        assert batches[1][1] - batches[1][0] == 15 * day
+        assert start <= batches[0][1] <= start + 1000
+
+        index.refresh()
+        assert sorted(index.get('JIRAA-1'), key=lambda x: x['permaId']['id']) \
+            == [{'permaId': {'id': 'CRUA-1'}, 'state': 'Closed'},
+                {'permaId': {'id': 'CRUA-2'}, 'state': 'Review'}]
+
+    # Then reviews from the previous refresh
+    assert all('toDate' not in x for x in queries[4:])
+    assert start - 2 * REVIEWS_INDEX_OVERLAP <= \
+        int(queries[4]['fromDate'][0]) <= start
+    assert len(index) == 1
+
+
+def test_reviews_index_disabled():
+    index = ReviewsIndex(server, refresh_interval=0)
+    with controlled_responses():
+        index.set('JIRAA-1', [])
+        assert index.get('JIRAA-1') is None
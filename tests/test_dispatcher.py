@@ -0,0 +1,96 @@
+import threading
+import time
+
+from mock import MagicMock
+from slackbot.dispatcher import Message
+
+from utils.dispatcher import Dispatcher, dispatched
+
+
+def test_submit():
+    dispatcher = Dispatcher('test', workers=2)
+    results = []
+
+    assert dispatcher.submit(results.append, 1)
+    assert dispatcher.submit(results.append, 2)
+    dispatcher.join()
+
+    assert sorted(results) == [1, 2]
+
+
+def test_handler_error():
+    dispatcher = Dispatcher('test', workers=1)
+    results = []
+
+    def fail():
+        raise ValueError()
+
+    dispatcher.submit(fail)
+    dispatcher.submit(results.append, 1)
+    dispatcher.join()
+
+    assert results == [1]
+
+
+def test_handler_error_reply():
+    dispatcher = Dispatcher('test', workers=1)
+    message = MagicMock(spec=Message)
+
+    def handler(message):
+        raise ValueError()
+
+    dispatcher.submit(handler, message)
+    dispatcher.join()
+
+    message.reply.assert_called_once_with(
+        '[handler] I had a problem handling your message')
+
+
+def test_queue_full():
+    dispatcher = Dispatcher('test', workers=1, queue_size=1)
+    event = threading.Event()
+
+    dispatcher.submit(event.wait)
+    while len(dispatcher) > 0:
+        time.sleep(0.01)
+
+    # Worker is busy, only one message can wait
+    message = MagicMock(spec=Message)
+    assert dispatcher.submit(lambda message: None, message)
+    assert not dispatcher.submit(lambda message: None, message)
+    assert dispatcher.rejected == 1
+    message.reply.assert_called_once_with(
+        'Too many requests, please try again later')
+
+    event.set()
+    dispatcher.join()
+
+
+def test_max_age():
+    dispatcher = Dispatcher('test', workers=1, max_age=0.05)
+    results = []
+
+    message = MagicMock(spec=Message)
+
+    dispatcher.submit(time.sleep, 0.1)
+    dispatcher.submit(results.append, message)
+    dispatcher.join()
+
+    assert results == []
+    assert dispatcher.expired == 1
+    message.reply.assert_called_once_with(
+        'Too busy to handle your request, please try again later')
+
+
+def test_dispatched():
+    results = []
+    event = threading.Event()
+
+    @dispatched('test_dispatched')
+    def handler(message, value):
+        results.append((message, value))
+        event.set()
+
+    assert handler('message', 'value') is None
+    assert event.wait(timeout=5)
+    assert results == [('message', 'value')]
@@ -0,0 +1,175 @@
+import base64
+import responses
+
+import utils.imageproxy as imageproxy
+from .common import controlled_responses
+
+GIF = 'R0lGODlhAQABAIAAAP///wAAACwAAAAAAQABAAACAkQBADs='
+GIFHASH = '09be089b62c4159231555df14d8cd77a2041efa0f0e5391368061aa3caf45a7d'
+
+
+def get_icon_request():
+    return {
+        'url': 'http://host/icon.gif',
+        'code': 200,
+        'content_type': 'image/gif',
+        'text': GIF
+    }
+
+
+def test_convert_proxyurl():
+    with controlled_responses([get_icon_request()]):
+        url = imageproxy.convert_proxyurl(
+                                          'http://imageproxy',
+                                          'http://host/icon.gif')
+
+    assert url == 'http://imageproxy/image/aW1hZ2UvZ2lm/' \
+        'R0lGODlhAQABAIAAAP___wAAACwAAAAAAQABAAACAkQBADs='
+
+
+def test_convert_proxyurl_notfound():
+    requests_get = [{'url': 'http://host/icon.gif', 'code': 404}]
+    with controlled_responses(requests_get):
+        url = imageproxy.convert_proxyurl(
+                                          'http://imageproxy',
+                                          'http://host/icon.gif')
+
+    assert url == 'http://host/icon.gif'
+
+
+def test_convert_proxyurl_upload():
+    with controlled_responses([get_icon_request()]) as rsps:
+        rsps.rsps.add(responses.POST, 'http://uploadproxy/upload',
+                      status=201, body=GIFHASH)
+        url = imageproxy.convert_proxyurl(
+                                          'http://uploadproxy',
+                                          'http://host/icon.gif',
+                                          upload=True)
+        assert url == 'http://uploadproxy/image/' + GIFHASH
+
+    # Icon is only downloaded and registered once
+    with controlled_responses():
+        url = imageproxy.convert_proxyurl(
+                                          'http://uploadproxy',
+                                          'http://host/icon.gif',
+                                          upload=True)
+        assert url == 'http://uploadproxy/image/' + GIFHASH
+
+
+def test_convert_proxyurl_upload_key(monkeypatch):
+    # Registrations expire as the proxy cache may have lost the icon
+    monkeypatch.setattr(getattr(imageproxy, '__registered'), 'ttl', 0)
+    with controlled_responses([get_icon_request()]) as rsps:
+        rsps.rsps.add(responses.POST, 'http://tokenproxy/upload',
+                      status=201, body='a' * 64 + '\n')
+        rsps.rsps.add(responses.POST, 'http://tokenproxy/upload',
+                      status=201, body='b' * 64)
+
+        url1 = imageproxy.convert_proxyurl('http://tokenproxy',
+                                           'http://host/icon.gif',
+                                           upload=True,
+                                           token='secret')
+        url2 = imageproxy.convert_proxyurl('http://tokenproxy',
+                                           'http://host/icon.gif',
+                                           upload=True,
+                                           token='secret')
+
+        assert rsps.calls[1].request.headers['Authorization'] == \
+            'Bearer secret'
+
+    # The URL uses the key returned by the proxy
+    assert url1 == 'http://tokenproxy/image/' + 'a' * 64
+    assert url2 == 'http://tokenproxy/image/' + 'b' * 64
+
+
+def test_convert_proxyurl_upload_error(monkeypatch):
+    with controlled_responses([get_icon_request()]) as rsps:
+        rsps.add_post('http://errorproxy/upload', 403, None)
+        url = imageproxy.convert_proxyurl(
+                                          'http://errorproxy',
+                                          'http://host/icon.gif',
+                                          upload=True)
+        assert url.startswith('http://errorproxy/image/aW1hZ2UvZ2lm/')
+
+    # Failed registration is not sent again on each render
+    with controlled_responses():
+        url = imageproxy.convert_proxyurl(
+                                          'http://errorproxy',
+                                          'http://host/icon.gif',
+                                          upload=True)
+        assert url.startswith('http://errorproxy/image/aW1hZ2UvZ2lm/')
+
+    # Until the failure expires
+    monkeypatch.setattr(getattr(imageproxy, '__failed_registrations'),
+                        'ttl', 0)
+    getattr(imageproxy, '__failed_registrations').clear()
+    with controlled_responses() as rsps:
+        rsps.rsps.add(responses.POST, 'http://errorproxy/upload',
+                      status=201, body=GIFHASH)
+        url = imageproxy.convert_proxyurl(
+                                          'http://errorproxy',
+                                          'http://host/icon.gif',
+                                          upload=True)
+        assert url == 'http://errorproxy/image/' + GIFHASH
+
+
+def test_convert_proxyurl_upload_timeout():
+    with controlled_responses([get_icon_request()]) as rsps:
+        rsps.rsps.add(responses.POST, 'http://timeoutproxy/upload',
+                      status=201, body=GIFHASH)
+        imageproxy.convert_proxyurl('http://timeoutproxy',
+                                    'http://host/icon.gif',
+                                    upload=True)
+
+        assert rsps.calls[-1].request.url == 'http://timeoutproxy/upload'
+
+    adapter = getattr(imageproxy, '__session').get_adapter(
+        'http://timeoutproxy/upload')
+    assert adapter.timeout == imageproxy.REQUEST_TIMEOUT
+
+
+def test_icons_cache():
+    with controlled_responses([get_icon_request()]):
+        url1 = imageproxy.convert_proxyurl(
+                                           'http://imageproxy',
+                                           'http://host/icon.gif')
+    with controlled_responses():
+        url2 = imageproxy.convert_proxyurl(
+                                           'http://imageproxy',
+                                           'http://host/icon.gif')
+
+    assert url1 == url2
+    assert imageproxy.get_icons_cache_stats() == {
+        'hits': 1,
+        'revalidations': 0,
+        'misses': 1,
+        'hit_ratio': 0.5
+    }
+
+
+def test_icons_cache_revalidation(monkeypatch):
+    monkeypatch.setattr(imageproxy, 'ICONS_CACHE_RETENTION', 0)
+
+    with controlled_responses() as rsps:
+        rsps.rsps.add(
+            responses.GET,
+            'http://host/icon.gif',
+            body=base64.b64decode(GIF),
+            content_type='image/gif',
+            adding_headers={'ETag': '"etag"'})
+        rsps.rsps.add(
+            responses.GET,
+            'http://host/icon.gif',
+            status=304)
+
+        url1 = imageproxy.convert_proxyurl(
+                                           'http://imageproxy',
+                                           'http://host/icon.gif')
+        url2 = imageproxy.convert_proxyurl(
+                                           'http://imageproxy',
+                                           'http://host/icon.gif')
+
+        assert rsps.calls[1].request.headers['If-None-Match'] == '"etag"'
+
+    assert url1 == url2
+    assert imageproxy.get_icons_cache_stats()['revalidations'] == 1
@@ -0,0 +1,90 @@
+import os
+import pytest
+from mock import patch
+
+from imageproxy.disk_cache import DiskCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return DiskCache(str(tmpdir))
+
+
+def test_get_set(cache):
+    assert cache.get('key') is None
+    cache.set('key', (b'content', 'image/png'))
+    assert cache.get('key') == (b'content', 'image/png')
+
+
+def test_shared_directory(cache):
+    cache.set('key', (b'content', 'image/png'))
+    other = DiskCache(cache.directory)
+    assert other.get('key') == (b'content', 'image/png')
+
+
+def test_no_temporary_files(cache):
+    cache.set('key', (b'content', 'image/png'))
+    assert os.listdir(cache.directory) == ['key']
+
+
+def test_eviction(tmpdir):
+    cache = DiskCache(str(tmpdir), max_size=30)
+    cache.set('key1', (b'0123456789', 'image/png'))
+    os.utime(os.path.join(cache.directory, 'key1'), (0, 0))
+    cache.set('key2', (b'0123456789', 'image/png'))
+
+    assert cache.get('key1') is None
+    assert cache.get('key2') == (b'0123456789', 'image/png')
+
+
+def test_eviction_size_in_memory(tmpdir):
+    cache = DiskCache(str(tmpdir), max_size=90)
+
+    # Directory is only scanned again once the cache is full
+    with patch('os.listdir', wraps=os.listdir) as listdir:
+        for i in range(4):
+            cache.set('key%d' % i, (b'0123456789', 'image/png'))
+            os.utime(os.path.join(cache.directory, 'key%d' % i), (i, i))
+        assert not listdir.called
+
+        cache.set('key4', (b'0123456789', 'image/png'))
+        assert listdir.call_count == 1
+
+    # Least recently used entries are evicted
+    assert sorted(os.listdir(cache.directory)) == \
+        ['key1', 'key2', 'key3', 'key4']
+
+
+def test_existing_entries_size(tmpdir):
+    DiskCache(str(tmpdir)).set('key1', (b'0123456789', 'image/png'))
+    os.utime(os.path.join(str(tmpdir), 'key1'), (0, 0))
+
+    cache = DiskCache(str(tmpdir), max_size=30)
+    cache.set('key2', (b'0123456789', 'image/png'))
+
+    assert cache.get('key1') is None
+
+
+def test_replace_opened_entry(cache):
+    cache.set('key', (b'content', 'image/png'))
+
+    with patch('os.replace', side_effect=PermissionError):
+        cache.set('key', (b'content', 'image/png'))
+
+    assert os.listdir(cache.directory) == ['key']
+    assert cache.get('key') == (b'content', 'image/png')
+
+
+def test_invalid_entry(cache):
+    with open(os.path.join(cache.directory, 'key'), 'wb') as f:
+        f.write(b'content')
+
+    assert cache.get('key') is None
+
+
+def test_clear(cache):
+    cache.set('key1', (b'content', 'image/png'))
+    cache.set('key2', (b'content', 'image/gif'))
+    cache.clear()
+    assert cache.get('key1') is None
+    assert cache.get('key2') is None
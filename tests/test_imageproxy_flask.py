@@ -1,5 +1,7 @@
 import pytest
 import imageproxy.flask_app
+from imageproxy.disk_cache import DiskCache
+from utils.imageproxy import decode, content_hash
 
 GIFURL = '/image/aW1hZ2UvZ2lm/R0lGODlhAQABAIAAAP___wAAACwAAAAAAQABAAACAkQBADs='
 
@@ -14,12 +16,23 @@ def app():
 
 
 @pytest.fixture
-def cache():
-    cache = imageproxy.flask_app.cache
-    cache.clear()
+def cache(tmpdir, monkeypatch):
+    cache = DiskCache(str(tmpdir))
+    monkeypatch.setattr(imageproxy.flask_app, 'cache', cache)
     return cache
 
 
+@pytest.fixture
+def upload_token(monkeypatch):
+    monkeypatch.setattr(imageproxy.flask_app, 'UPLOAD_TOKEN', 'token')
+    return 'token'
+
+
+def get_cachekey(url):
+    content_type, content = url.split('/')[2:]
+    return content_hash(decode(content_type).decode(), decode(content))
+
+
 def test_is_debug(app):
     assert not app.debug
 
@@ -42,7 +55,7 @@ def test_validate_url(client):
 ])
 def test_image_get(cache, client, url, content_type, result_header):
     expected_cache_retention = imageproxy.flask_app.CACHE_RETENTION
-    assert cache.get(url) is None
+    assert cache.get(get_cachekey(url)) is None
 
     response = client.get(url)
     assert response.status_code == 200
@@ -50,10 +63,75 @@ def test_image_get(cache, client, url, content_type, result_header):
     assert response.cache_control.max_age == expected_cache_retention
     assert response.data.startswith(result_header)
 
-    assert cache.get(url) is not None
+    assert cache.get(get_cachekey(url)) is not None
 
     response = client.get(url)
     assert response.status_code == 200
     assert response.content_type == content_type
     assert response.cache_control.max_age == expected_cache_retention
     assert response.data.startswith(result_header)
+
+
+def test_image_get_from_shared_cache(cache, client, monkeypatch):
+    client.get(SVGURL)
+
+    # Another worker sharing the cache directory never converts again
+    monkeypatch.setattr(
+        imageproxy.flask_app,
+        'cache',
+        DiskCache(cache.directory))
+
+    def svg2png(data):
+        raise AssertionError('Image should be served from cache')
+    monkeypatch.setattr(imageproxy.flask_app, '__svg2png', svg2png)
+
+    response = client.get(SVGURL)
+    assert response.status_code == 200
+    assert response.content_type == 'image/png'
+    assert response.data.startswith(b'\x89PNG')
+
+
+@pytest.mark.parametrize('url,content_type,result_header', [
+    (GIFURL, 'image/gif', b'GIF89a'),
+    (SVGURL, 'image/png', b'\x89PNG')
+])
+def test_image_register(cache, client, url, content_type, result_header,
+                        upload_token):
+    cachekey = get_cachekey(url)
+    assert client.get('/image/' + cachekey).status_code == 404
+
+    original_content_type, content = url.split('/')[2:]
+    response = client.post(
+        '/upload',
+        data=decode(content),
+        content_type=decode(original_content_type).decode(),
+        headers={'Authorization': 'Bearer ' + upload_token})
+    assert response.status_code == 201
+    assert response.data.decode() == cachekey
+
+    response = client.get('/image/' + cachekey)
+    assert response.status_code == 200
+    assert response.content_type == content_type
+    assert response.data.startswith(result_header)
+
+
+def test_image_register_invalid(cache, client, upload_token):
+    headers = {'Authorization': 'Bearer ' + upload_token}
+    assert client.post('/upload', headers=headers).status_code == 400
+    assert client.get('/image/..').status_code == 404
+
+
+def test_image_register_unauthorized(cache, client, upload_token,
+                                     monkeypatch):
+    data = decode(GIFURL.split('/')[3])
+    assert client.post('/upload', data=data,
+                       content_type='image/gif').status_code == 403
+    assert client.post('/upload', data=data, content_type='image/gif',
+                       headers={'Authorization': 'Bearer other'}
+                       ).status_code == 403
+
+    # Uploads are disabled without token
+    monkeypatch.setattr(imageproxy.flask_app, 'UPLOAD_TOKEN', None)
+    assert client.post('/upload', data=data, content_type='image/gif',
+                       headers={'Authorization': 'Bearer None'}
+                       ).status_code == 403
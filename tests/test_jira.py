@@ -1,13 +1,18 @@
+import copy
 import pytest
 from mock import MagicMock, mock
 import responses
 import re
 import json
 from threading import Event
+from urllib.parse import parse_qs, urlparse
 
 import utils.notifier_bot as notifier_bot
+import utils.imageproxy as imageproxy
 from .common import controlled_responses, get_message
-from plugins.jira import JiraBot, JiraNotifierBot
+import plugins.jira
+from plugins.jira import JiraBot, JiraNotifierBot, JiraCombinedNotifierJob
+from utils.checkpoint_store import CheckpointStore
 from utils.messages_cache import MessagesCache
 
 
@@ -54,6 +59,7 @@ def test_jirapattern(bot, input, expected):
                          ('JIRA-1 & JIRA-2', data['jirabot_result']),
                          ('JIRA-1 & JIRA-1', data['jirabot_result1']),
                          ('JIRA-3', data['jirabot_notexist']),
+                         ('JIRA-3 & JIRA-1', data['jirabot_partial']),
                          ])
 def test_display_issues(bot, input, testdata):
     with controlled_responses(testdata['requests']):
@@ -83,6 +89,8 @@ def test_messages_cache(bot, input, testdata):
         bot.display_issues(message)
         assert not message.send_webapi.called
 
+    bot.issues_cache.clear()
+    imageproxy.clear_icons_cache()
     with controlled_responses(testdata['requests']):
         # Call on another channel should display the message again
         message = get_message(input, channel='channel2')
@@ -90,11 +98,65 @@ def test_messages_cache(bot, input, testdata):
         assert message.send_webapi.called
 
 
+def test_issues_cache(bot):
+    testdata = data['jirabot_result1']
+    with controlled_responses(testdata['requests']):
+        message = get_message('JIRA-1', channel='channel1')
+        bot.display_issues(message)
+
+    # Issue details are served from cache without any request
+    with controlled_responses():
+        message = get_message('JIRA-1', channel='channel2')
+        bot.display_issues(message)
+        args, kwargs = message.send_webapi.call_args
+        assert json.loads(args[1]) == testdata['result']
+
+        assert bot.get_issue_status('JIRA-1') == 'Open'
+        assert bot.get_issue_message('JIRA-1') == testdata['result'][0]
+
+    assert bot.issues_cache.stats == {'entries': 1, 'hits': 3, 'misses': 1}
+
+
+def test_issues_search_pages():
+    bot = JiraBot(MessagesCache(), dict(server, search_page_size=2), prefixes)
+    issue = data['jirabot_result1']['requests'][0]['text']['issues'][0]
+
+    def search(request):
+        # Server returns a single issue per page whatever maxResults is
+        query = parse_qs(urlparse(request.url).query)
+        keys = re.search(r'key in \((.*)\)', query['jql'][0]).group(1)
+        keys = keys.split(',')
+        start = int(query['startAt'][0])
+        issues = [dict(issue, key=key) for key in keys[start:start + 1]]
+        return (200, {}, json.dumps({'total': len(keys), 'issues': issues}))
+
+    with controlled_responses(data['jirabot_result1']['requests'][1:]) \
+            as rsps:
+        for _ in range(3):
+            rsps.rsps.add_callback(
+                responses.GET,
+                re.compile(r'http://host/rest/api/2/search\?.+'),
+                callback=search)
+
+        attachments = bot.get_issues_messages(['JIRA-1', 'JIRA-2', 'JIRA-3'])
+
+        queries = [parse_qs(urlparse(x.request.url).query)
+                   for x in rsps.calls if '/search' in x.request.url]
+        assert [(x['jql'][0], x['startAt'][0]) for x in queries] == [
+            ('key in (JIRA-1,JIRA-2)', '0'),
+            ('key in (JIRA-1,JIRA-2)', '1'),
+            ('key in (JIRA-3)', '0')
+        ]
+
+    assert [x['author_name'] for x in attachments] == \
+        ['JIRA-1', 'JIRA-2', 'JIRA-3']
+
+
 def test_wrong_auth(bot):
     with controlled_responses() as rsps:
         rsps.rsps.add(
             responses.GET,
-            'http://host/rest/api/2/issue/JIRA-1',
+            'http://host/rest/api/2/search',
             status=401)
 
         message = get_message('JIRA-1')
@@ -161,3 +223,270 @@ def test_notifier(testdata):
             call = slack_mock.send_message.call_args
             call_args, call_kwargs = call
             assert testdata['result'] == json.loads(call_kwargs['attachments'])
+
+
+def test_combined_notifier():
+    testdata = data['jiranotifier_changelog_with_assignee']
+    slack_mock = MagicMock()
+    slack_mock.channels = {
+        'channel_id1': {'name': 'channel1'},
+        'channel_id2': {'name': 'channel2'}
+    }
+    slack_mock.send_message = MagicMock()
+
+    conf = {
+        'polling_interval': 1,
+        'combined': True,
+        'notifiers': [
+            {'query': 'project = JIRA', 'channel': 'channel1'},
+            {'query': 'project = JIRB', 'channel': 'channel2'}
+        ]
+    }
+
+    search_url = re.compile(r'http?://host/rest/api/2/search.+')
+    issues = testdata['requests'][0]['text']
+    with controlled_responses(testdata['requests'][1:]) as rsps:
+        # Initial and combined searches, then one routing search by notifier
+        for body in [issues, issues, issues, {'total': 0, 'issues': []}]:
+            rsps.rsps.add(
+                responses.GET,
+                search_url,
+                status=200,
+                body=json.dumps(body),
+                content_type='application/json')
+
+        with JiraNotifierBot(server, conf, slack_mock) as obj:
+            assert len(obj._jobs) == 2
+            event = Event()
+
+            def notify(results):
+                original_notify(results)
+                event.set()
+
+            original_notify = obj._jobs[1].notify
+            obj._jobs[1].notify = notify
+            assert event.wait(timeout=5) is True
+
+        queries = [call.request.url for call in rsps.calls
+                   if '/search' in call.request.url]
+        assert 'project+%3D+JIRA%29+OR+%28project+%3D+JIRB' in queries[1]
+        assert 'key+in+%28JIRA-23510%29' in queries[2]
+
+        slack_mock.send_message.assert_called_once_with('channel_id1',
+                                                        '',
+                                                        attachments=mock.ANY)
+        call_args, call_kwargs = slack_mock.send_message.call_args
+        assert testdata['result'] == json.loads(call_kwargs['attachments'])
+
+
+
+class SearchResults(list):
+    total = 0
+
+
+def test_combined_notifier_checkpoints():
+    jira = MagicMock()
+    jira.search_issues.return_value = SearchResults()
+    jobs = [MagicMock(query='project = JIRA', channel='channel1'),
+            MagicMock(query='project = JIRB', channel='channel2'),
+            MagicMock(query='project = JIRC', channel='channel3')]
+    for index, job in enumerate(jobs):
+        job.name = 'notifier{}'.format(index)
+
+    checkpoints = CheckpointStore()
+    checkpoints.set('notifier0', '2015-07-21T10:00:00.000+0000', 'JIRA-2')
+    checkpoints.set('notifier1', '2015-07-21T09:00:00.000+0000', 'JIRB-1')
+    job = JiraCombinedNotifierJob(jira, jobs, 60, checkpoints)
+
+    # Switched on, combined search resumes from the oldest checkpoint
+    job.init()
+    assert checkpoints.get(job.name) == {
+        'updated': '2015-07-21T09:00:00.000+0000', 'key': 'JIRB-1'}
+    assert not jira.search_issues.called
+
+    # Notifiers resume from the combined checkpoint when switched off
+    job.run()
+    for name in ['notifier0', 'notifier1', 'notifier2']:
+        assert checkpoints.get(name) == checkpoints.get(job.name)
+
+@pytest.mark.parametrize('slackclient,token', [
+    (None, 'secret'),
+    (MagicMock(), ''),
+    (MagicMock(), None)
+])
+def test_webhook_not_started(slackclient, token):
+    conf = {
+        'polling_interval': 3600,
+        'webhook': {'enabled': True, 'port': 8090, 'token': token},
+        'notifiers': []
+    }
+
+    with mock.patch('plugins.jira.make_server') as make_server:
+        with JiraNotifierBot(server, conf, slackclient):
+            pass
+
+    assert not make_server.called
+
+
+def test_notify_closed_issue():
+    testdata = data['jiranotifier_changelog_with_assignee']
+    slack_mock = MagicMock()
+    slack_mock.channels = {'channel_id': {'name': 'atlassianbot-test'}}
+    slack_mock.send_message = MagicMock()
+
+    conf = {
+        'polling_interval': 3600,
+        'notifiers': [
+            {'query': 'project = JIRA', 'channel': 'atlassianbot-test'}
+        ]
+    }
+
+    issues = testdata['requests'][0]['text']
+    with controlled_responses(testdata['requests'][1:]) as rsps:
+        # Initial search of the polling fallback
+        rsps.rsps.add(
+            responses.GET,
+            re.compile(r'http?://host/rest/api/2/search\?jql=project.+'),
+            status=200,
+            body=json.dumps(issues),
+            content_type='application/json')
+
+        # Same webhook received twice
+        for _ in range(2):
+            rsps.rsps.add(
+                responses.GET,
+                re.compile(r'http?://host/rest/api/2/issue/JIRA-23510\?.+'),
+                status=200,
+                body=json.dumps(issues['issues'][0]),
+                content_type='application/json')
+            rsps.rsps.add(
+                responses.GET,
+                re.compile(r'http?://host/rest/api/2/search\?jql=key.+'),
+                status=200,
+                body=json.dumps(issues),
+                content_type='application/json')
+
+        with JiraNotifierBot(server, conf, slack_mock) as obj:
+            obj.notify_closed_issue('JIRA-23510')
+            obj.notify_closed_issue('JIRA-23510')
+
+        slack_mock.send_message.assert_called_once_with('channel_id',
+                                                        '',
+                                                        attachments=mock.ANY)
+        call_args, call_kwargs = slack_mock.send_message.call_args
+        assert testdata['result'] == json.loads(call_kwargs['attachments'])
+
+
+def test_notifier_checkpoint(tmpdir):
+    testdata = data['jiranotifier_changelog_with_assignee']
+    slack_mock = MagicMock()
+    slack_mock.channels = {'channel_id': {'name': 'atlassianbot-test'}}
+    slack_mock.send_message = MagicMock()
+
+    checkpoint_file = str(tmpdir.join('checkpoints.json'))
+    CheckpointStore(checkpoint_file).set('notifier',
+                                         '2015-07-21T10:00:00.000+0200',
+                                         'JIRA-1')
+
+    conf = {
+        'polling_interval': 1,
+        'checkpoint_file': checkpoint_file,
+        'notifiers': [
+            {
+                'name': 'notifier',
+                'query': 'project = JIRA',
+                'channel': 'atlassianbot-test'
+            }
+        ]
+    }
+
+    # No initial search, notifier resumes after checkpoint
+    with controlled_responses(testdata['requests'][1:]) as rsps:
+        rsps.rsps.add(
+            responses.GET,
+            re.compile(r'http?://host/rest/api/2/search.+'),
+            status=200,
+            body=json.dumps(testdata['requests'][0]['text']),
+            content_type='application/json')
+
+        with JiraNotifierBot(server, conf, slack_mock) as obj:
+            event = Event()
+            obj._jobs[0].run_callback = event.set
+            assert event.wait(timeout=5) is True
+
+        search = next(x.request.url for x in rsps.calls
+                      if '/rest/api/2/search' in x.request.url)
+        assert 'DURING%281437465600000' in search
+        assert 'key+NOT+IN+%28JIRA-1%29' in search
+        assert 'ORDER+BY+updated+ASC' in search
+
+    assert slack_mock.send_message.call_count == 1
+    assert CheckpointStore(checkpoint_file).get('notifier') == {
+        'updated': '2015-07-21T11:44:45.000+0200',
+        'key': 'JIRA-23510'
+    }
+
+
+def test_notifier_pages(monkeypatch, tmpdir):
+    monkeypatch.setattr(plugins.jira, 'NOTIFIER_PAGE_SIZE', 2)
+    testdata = data['jiranotifier_changelog_with_assignee']
+    slack_mock = MagicMock()
+    slack_mock.channels = {'channel_id': {'name': 'atlassianbot-test'}}
+    slack_mock.send_message = MagicMock()
+
+    checkpoint_file = str(tmpdir.join('checkpoints.json'))
+    CheckpointStore(checkpoint_file).set('notifier',
+                                         '2015-07-21T10:00:00.000+0200',
+                                         'JIRA-1')
+    conf = {
+        'polling_interval': 1,
+        'checkpoint_file': checkpoint_file,
+        'notifiers': [
+            {
+                'name': 'notifier',
+                'query': 'project = JIRA',
+                'channel': 'atlassianbot-test'
+            }
+        ]
+    }
+
+    issue = testdata['requests'][0]['text']['issues'][0]
+    issues = []
+    for key, updated in [('JIRA-23510', '2015-07-21T11:44:45.000+0200'),
+                         ('JIRA-23511', '2015-07-21T11:44:45.000+0200'),
+                         ('JIRA-23512', '2015-07-21T11:50:00.000+0200')]:
+        issues.append(copy.deepcopy(issue))
+        issues[-1]['key'] = key
+        issues[-1]['fields']['updated'] = updated
+
+    pages = [
+        {'total': 3, 'issues': issues[:2]},
+        {'total': 1, 'issues': issues[2:]}
+    ]
+    with controlled_responses(testdata['requests'][1:]) as rsps:
+        for page in pages:
+            rsps.rsps.add(
+                responses.GET,
+                re.compile(r'http?://host/rest/api/2/search.+'),
+                status=200,
+                body=json.dumps(page),
+                content_type='application/json')
+
+        with JiraNotifierBot(server, conf, slack_mock) as obj:
+            event = Event()
+            obj._jobs[0].run_callback = event.set
+            assert event.wait(timeout=5) is True
+
+        # Next page starts after the last issue instead of an offset
+        searches = [x.request.url for x in rsps.calls
+                    if '/rest/api/2/search' in x.request.url]
+        assert 'DURING%281437465600000' in searches[0]
+        assert 'DURING%281437471885000' in searches[1]
+        assert 'key+NOT+IN+%28JIRA-23510%2CJIRA-23511%29' in searches[1]
+        assert all('startAt=0' in x for x in searches)
+
+    assert [[x['author_name'] for x in json.loads(kwargs['attachments'])]
+            for args, kwargs in slack_mock.send_message.call_args_list] == \
+        [['JIRA-23510', 'JIRA-23511'], ['JIRA-23512']]
+    assert CheckpointStore(checkpoint_file).get('notifier')['key'] == \
+        'JIRA-23512'
@@ -0,0 +1,43 @@
+import pytest
+
+from utils.key_matcher import KeyMatcher
+
+
+@pytest.fixture
+def matcher():
+    matcher = KeyMatcher()
+    matcher.register('jira', ['JIRA', 'JIRB'], ignored_before=['CLEAN'])
+    matcher.register('crucible', ['CR', 'JIRA'])
+    return matcher
+
+
+@pytest.mark.parametrize('text,expected', [
+    ('JIRA-1234', ['JIRA-1234']),
+    ('jira-1234', ['jira-1234']),
+    ('IRA-1234', []),
+    ('SOMETHING JIRA-1234 SOMETHING', ['JIRA-1234']),
+    ('SOMETHINGJIRA-1234', []),
+    ('JIRA-1234SOMETHING', []),
+    ('JIRA-1234_', []),
+    ('JIRA-', []),
+    ('JIRA--1', []),
+    ('(JIRA-1), JIRB-2.', ['JIRA-1', 'JIRB-2']),
+    ('JIRA-1 JIRA-2 JIRA-1', ['JIRA-1', 'JIRA-2', 'JIRA-1']),
+    ('CLEAN JIRA-1234', []),
+    ('clean jira-1 JIRA-2', ['JIRA-2']),
+])
+def test_findall(matcher, text, expected):
+    assert matcher.findall('jira', text) == expected
+
+
+def test_groups(matcher):
+    text = 'CLEAN JIRA-1 CR-2 JIRB-3'
+    assert matcher.findall('jira', text) == ['JIRB-3']
+    assert matcher.findall('crucible', text) == ['JIRA-1', 'CR-2']
+    assert matcher.findall('unknown', text) == []
+
+
+def test_register_replaces_prefixes(matcher):
+    assert matcher.findall('jira', 'JIRB-1 JIRC-2') == ['JIRB-1']
+    matcher.register('jira', ['JIRC'])
+    assert matcher.findall('jira', 'JIRB-1 JIRC-2') == ['JIRC-2']
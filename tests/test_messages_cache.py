@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.messages_cache import MessagesCache
+
+
+def test_add_to_cache():
+    cache = MessagesCache()
+    assert not cache.IsInCache('key')
+    cache.AddToCache('key')
+    assert cache.IsInCache('key')
+
+
+def test_add_if_absent():
+    cache = MessagesCache()
+    assert cache.add_if_absent('key')
+    assert not cache.add_if_absent('key')
+    assert cache.IsInCache('key')
+
+
+def test_expiration():
+    cache = MessagesCache(retention_delay=0)
+    cache.AddToCache('key')
+    assert not cache.IsInCache('key')
+    assert cache.add_if_absent('key')
+    assert len(cache) == 0
+
+
+def test_max_entries():
+    cache = MessagesCache(max_entries=2, stripes=1)
+    cache.AddToCache('key1')
+    cache.AddToCache('key2')
+    cache.AddToCache('key3')
+
+    assert not cache.IsInCache('key1')
+    assert cache.IsInCache('key2')
+    assert cache.IsInCache('key3')
+
+
+def test_readd_refreshes_entry():
+    cache = MessagesCache(max_entries=2, stripes=1)
+    cache.AddToCache('key1')
+    cache.AddToCache('key2')
+    cache.AddToCache('key1')
+    cache.AddToCache('key3')
+
+    # Oldest queued entry of key1 is outdated and must not evict it
+    assert cache.IsInCache('key1')
+    assert not cache.IsInCache('key2')
+    assert cache.IsInCache('key3')
+
+
+def test_concurrent_add_if_absent():
+    cache = MessagesCache()
+    keys = ['key{}'.format(x % 100) for x in range(10000)]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(cache.add_if_absent, keys))
+
+    assert results.count(True) == 100
+    assert len(cache) == 100
@@ -0,0 +1,125 @@
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+
+import utils.rest as rest
+from utils.metrics import Metrics, get_endpoint, metrics, serve
+from .common import controlled_responses
+
+server = {'host': 'http://host', 'username': 'user', 'password': 'pass'}
+
+
+@pytest.fixture(autouse=True)
+def reset():
+    rest.close_sessions()
+    metrics.reset()
+    yield
+    rest.close_sessions()
+
+
+@pytest.mark.parametrize('url,expected', [
+    ('http://host/rest/api/2/search?jql=key', '/rest/api/2/search'),
+    ('http://host/rest/api/2/issue/JIRA-1', '/rest/api/2/issue/{id}'),
+    ('http://host/rest-service/reviews-v1/CRUA-1/reviewers/uncompleted',
+     '/rest-service/reviews-v1/{id}/reviewers/uncompleted'),
+    ('http://host/rest/api/latest/queue/deployment/1234',
+     '/rest/api/latest/queue/deployment/{id}'),
+    ('http://host/rest/api/latest/plan/BAMA-DEV',
+     '/rest/api/latest/plan/{id}'),
+    ('http://host/rest/api/latest/plan/BAMA-DEV123/branch',
+     '/rest/api/latest/plan/{id}/branch'),
+])
+def test_get_endpoint(url, expected):
+    assert get_endpoint(url) == expected
+
+
+def test_observe():
+    registry = Metrics(buckets=(0.1, 1))
+    registry.observe('host', 'GET', 'http://host/a/A-1', 200, 0.05)
+    registry.observe('host', 'GET', 'http://host/a/A-2', 404, 0.5)
+    registry.observe('host', 'GET', 'http://host/a/A-3', 200, 5)
+
+    assert registry.get_stats() == {
+        ('host', 'GET', '/a/{id}'): {
+            'count': 3,
+            'retries': 0,
+            'duration': 5.55,
+            'statuses': {'200': 2, '404': 1},
+            'buckets': [(0.1, 1), (1, 1)]
+        }
+    }
+
+
+def test_max_endpoints():
+    registry = Metrics(max_endpoints=2)
+    for path in ['a', 'b', 'c', 'd']:
+        registry.observe('host', 'GET', 'http://host/' + path, 200, 0.1)
+
+    stats = registry.get_stats()
+    assert sorted(stats) == [('host', 'GET', '/a'),
+                             ('host', 'GET', '/b'),
+                             ('host', 'GET', 'other')]
+    assert stats[('host', 'GET', 'other')]['count'] == 2
+
+
+def test_retries():
+    registry = Metrics()
+    registry.observe('host', 'GET', 'http://host/a', 503, 0.1)
+    registry.observe('host', 'GET', 'http://host/a', 'error', 0.1)
+    registry.observe('host', 'GET', 'http://host/a', 200, 0.1)
+    registry.observe('host', 'GET', 'http://host/a', 200, 0.1)
+
+    assert registry.get_stats()[('host', 'GET', '/a')]['retries'] == 2
+
+
+def test_rest_requests():
+    requests_get = [
+        {'url': 'http://host/rest/review/CR-1', 'code': 200, 'text': {}},
+        {'url': 'http://host/rest/review/CR-2', 'code': 404, 'text': {}}
+    ]
+    with controlled_responses(requests_get, server):
+        rest.get(server, '/rest/review/CR-1')
+        rest.get(server, '/rest/review/CR-2')
+
+    stats = metrics.get_stats()[('host', 'GET', '/rest/review/{id}')]
+    assert stats['count'] == 2
+    assert stats['statuses'] == {'200': 1, '404': 1}
+
+
+def test_prometheus():
+    registry = Metrics(buckets=(0.1, 1))
+    registry.observe('host', 'GET', 'http://host/a', 200, 0.5)
+
+    assert registry.to_prometheus().splitlines()[3:] == [
+        'atlassianbot_requests_total'
+        '{backend="host",method="GET",endpoint="/a",status="200"} 1',
+        'atlassianbot_request_retries_total'
+        '{backend="host",method="GET",endpoint="/a"} 0',
+        'atlassianbot_request_duration_seconds_bucket'
+        '{backend="host",method="GET",endpoint="/a",le="0.1"} 0',
+        'atlassianbot_request_duration_seconds_bucket'
+        '{backend="host",method="GET",endpoint="/a",le="1"} 1',
+        'atlassianbot_request_duration_seconds_bucket'
+        '{backend="host",method="GET",endpoint="/a",le="+Inf"} 1',
+        'atlassianbot_request_duration_seconds_sum'
+        '{backend="host",method="GET",endpoint="/a"} 0.5',
+        'atlassianbot_request_duration_seconds_count'
+        '{backend="host",method="GET",endpoint="/a"} 1',
+    ]
+
+
+def test_serve():
+    registry = Metrics()
+    registry.observe('host', 'GET', 'http://host/a', 200, 0.5)
+    metrics_server = serve(0, '127.0.0.1', registry)
+    try:
+        url = 'http://127.0.0.1:{}'.format(metrics_server.server_port)
+        with urlopen(url + '/metrics') as response:
+            assert response.read().decode() == registry.to_prometheus()
+
+        with pytest.raises(HTTPError):
+            urlopen(url + '/other')
+    finally:
+        metrics_server.shutdown()
+        metrics_server.server_close()
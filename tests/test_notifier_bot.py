@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mock import MagicMock
+
+from utils.notifier_bot import NotifierJob, NotifierScheduler
+
+
+class CountingJob(NotifierJob):
+    def __init__(self, polling_interval, backend=None, duration=0):
+        super().__init__('channel', polling_interval, backend)
+        self.duration = duration
+        self.inits = 0
+        self.runs = []
+
+    def init(self):
+        self.inits += 1
+
+    def run(self):
+        self.runs.append(time.monotonic())
+        time.sleep(self.duration)
+
+
+def run_scheduler(jobs, duration, **kwargs):
+    executor = ThreadPoolExecutor(max_workers=4)
+    scheduler = NotifierScheduler(executor, max_jitter=0, **kwargs)
+    for job in jobs:
+        scheduler.schedule(job)
+
+    time.sleep(duration)
+    scheduler.stop()
+    executor.shutdown(wait=True)
+    scheduler.close()
+    return scheduler
+
+
+def test_fixed_cadence():
+    # Runs take half of the polling interval and must not delay next runs
+    job = CountingJob(0.1, duration=0.05)
+    run_scheduler([job], 0.75)
+
+    assert job.inits == 1
+    assert 6 <= len(job.runs) <= 7
+    intervals = [b - a for a, b in zip(job.runs, job.runs[1:])]
+    assert all(0.05 < x < 0.15 for x in intervals)
+
+
+def test_backend_concurrency():
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    class BlockingJob(CountingJob):
+        def run(self):
+            with lock:
+                running.append(self)
+                max_running.append(len(running))
+            time.sleep(0.1)
+            with lock:
+                running.remove(self)
+
+    jobs = [BlockingJob(0.05, backend='backend') for _ in range(3)]
+    run_scheduler(jobs, 0.5, max_backend_concurrency=1)
+
+    assert max(max_running) == 1
+
+
+def test_skip_busy_job():
+    # Runs last longer than the polling interval and must not be queued
+    job = CountingJob(0.1, duration=0.25)
+    scheduler = run_scheduler([job], 0.75)
+
+    assert 2 <= len(job.runs) <= 3
+    assert scheduler.skipped >= 3
+
+
+def test_send_message_split():
+    slackclient = MagicMock()
+    slackclient.channels = {'channel_id': {'name': 'channel'}}
+    job = CountingJob(1)
+    assert job._bind(slackclient)
+
+    job.send_message([{'text': str(x)} for x in range(45)])
+
+    calls = slackclient.send_message.call_args_list
+    assert [len(json.loads(kwargs['attachments']))
+            for args, kwargs in calls] == [20, 20, 5]
+    assert json.loads(calls[2][1]['attachments'])[-1] == {'text': '44'}
@@ -0,0 +1,84 @@
+import pytest
+import threading
+from http.server import BaseHTTPRequestHandler
+from socketserver import ThreadingTCPServer
+
+import utils.rest as rest
+from .common import controlled_responses
+
+server = {'host': 'http://host', 'username': 'user', 'password': 'pass'}
+other_server = {'host': 'http://otherhost'}
+
+
+@pytest.fixture(autouse=True)
+def sessions():
+    rest.close_sessions()
+    yield
+    rest.close_sessions()
+
+
+def test_session_auth():
+    requests_get = [
+        {'url': 'http://host/path', 'code': 200, 'text': {}},
+        {'url': 'http://host/path?a=1', 'code': 200, 'text': {}}
+    ]
+    with controlled_responses(requests_get, server) as rsps:
+        rest.get(server, '/path')
+        rest.get(server, '/path', {'a': 1})
+        assert len(rsps.calls) == 2
+
+
+def test_anonymous_session():
+    requests_get = [{'url': 'http://otherhost/path', 'code': 200, 'text': {}}]
+    with controlled_responses(requests_get) as rsps:
+        rest.get(other_server, '/path')
+        assert 'Authorization' not in rsps.calls[0].request.headers
+
+
+def test_session_per_server():
+    requests_get = [
+        {'url': 'http://host/path', 'code': 200, 'text': {}},
+        {'url': 'http://host/path', 'code': 200, 'text': {}},
+        {'url': 'http://otherhost/path', 'code': 200, 'text': {}}
+    ]
+    with controlled_responses(requests_get):
+        rest.get(server, '/path')
+        rest.get(server, '/path')
+        rest.get(other_server, '/path')
+
+    stats = rest.get_pool_stats()
+    assert sorted(stats.keys()) == ['http://host', 'http://otherhost']
+
+
+def test_pool_stats():
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, format, *args):
+            pass
+
+    # Keep-alive connections are served by their own thread
+    class Server(ThreadingTCPServer):
+        daemon_threads = True
+
+    httpserver = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpserver.serve_forever, daemon=True).start()
+    try:
+        local_server = {
+            'host': 'http://127.0.0.1:{}'.format(httpserver.server_address[1])
+        }
+        for _ in range(5):
+            rest.get(local_server, '/path')
+
+        stats = rest.get_pool_stats()
+        assert stats[local_server['host']] == {'opened': 1, 'reused': 4}
+    finally:
+        httpserver.shutdown()
+        httpserver.server_close()
@@ -0,0 +1,151 @@
+import json
+import threading
+
+import pytest
+import responses
+
+from plugins.stash import Stash
+from .common import controlled_responses
+
+server = {'host': 'http://host', 'username': 'user', 'password': 'pass'}
+
+BRANCHES_URL = 'http://host/rest/api/1.0/projects/project/repos/{}/branches' \
+    '?filterText=JIRA-1&limit=100&details=True'
+
+
+def get_branch(name):
+    return {
+        'id': 'refs/heads/' + name,
+        'displayId': name,
+        'latestChangeset': name + '-changeset'
+    }
+
+
+def get_page_request(repo, branches, start=None, next_start=None):
+    url = BRANCHES_URL.format(repo)
+    if start is not None:
+        url += '&start={}'.format(start)
+
+    text = {'values': [get_branch(b) for b in branches]}
+    if next_start is not None:
+        text.update({'isLastPage': False, 'nextPageStart': next_start})
+    else:
+        text['isLastPage'] = True
+
+    return {'url': url, 'code': 200, 'text': text}
+
+
+def get_compare_request(repo, branch, to, size, code=200):
+    url = 'http://host/rest/api/1.0/projects/project/repos/{}/compare/' \
+        'changes/?from=refs%2Fheads%2F{}&to=refs%2Fheads%2F{}&limit=1' \
+        .format(repo, branch, to)
+    return {'url': url, 'code': code, 'text': {'size': size}}
+
+
+def get_merge_status(stash, basebranches):
+    status = list(stash.get_branches_merge_status(
+        ['repo1'], 'project', 'JIRA-1',
+        ['refs/heads/' + b for b in basebranches]))
+    stash._Stash__executor.shutdown(wait=True)
+
+    return [(b[2], b[4]) for b in status]
+
+
+@pytest.fixture
+def stash():
+    return Stash(server)
+
+
+def test_get_stash_branches_pages(stash):
+    requests_get = [
+        get_page_request('repo1', ['b1', 'b2'], next_start=2),
+        get_page_request('repo1', ['b3'], start=2, next_start=3),
+        get_page_request('repo1', ['b4'], start=3),
+        get_page_request('repo2', ['b5'])
+    ]
+    with controlled_responses(requests_get, server):
+        branches = stash.get_stash_branches(['repo1', 'repo2'],
+                                            'project',
+                                            'JIRA-1')
+
+    assert [(b[0], b[2]) for b in branches] == [
+        ('repo1', 'b1'),
+        ('repo1', 'b2'),
+        ('repo1', 'b3'),
+        ('repo1', 'b4'),
+        ('repo2', 'b5')
+    ]
+
+
+def test_get_stash_branches_max_pages(stash):
+    requests_get = [
+        get_page_request('repo1', ['b1'], next_start=1),
+        get_page_request('repo1', ['b2'], start=1, next_start=2),
+    ]
+    with controlled_responses(requests_get, server):
+        branches = stash.get_stash_branches(['repo1'],
+                                            'project',
+                                            'JIRA-1',
+                                            max_pages=2)
+
+    assert [b[2] for b in branches] == ['b1', 'b2']
+
+
+def test_get_branches_merge_status(stash):
+    requests_get = [
+        get_page_request('repo1', ['b1', 'b2']),
+        get_compare_request('repo1', 'b1', 'master', 3),
+        get_compare_request('repo1', 'b1', 'develop', 0),
+        get_compare_request('repo1', 'b2', 'master', 2),
+        get_compare_request('repo1', 'b2', 'develop', 1)
+    ]
+    with controlled_responses(requests_get, server):
+        status = get_merge_status(stash, ['master', 'develop'])
+
+    assert status == [('b1', True), ('b2', False)]
+
+
+def test_get_branches_merge_status_missing_base(stash):
+    requests_get = [
+        get_page_request('repo1', ['b1']),
+        get_compare_request('repo1', 'b1', 'missing', None, code=404),
+        get_compare_request('repo1', 'b1', 'master', 0)
+    ]
+    with controlled_responses(requests_get, server):
+        status = get_merge_status(stash, ['missing', 'master'])
+
+    assert status == [('b1', True)]
+
+
+def test_get_branches_merge_status_missing_base_unmerged(stash):
+    requests_get = [
+        get_page_request('repo1', ['b1']),
+        get_compare_request('repo1', 'b1', 'missing', None, code=404),
+        get_compare_request('repo1', 'b1', 'master', 1)
+    ]
+    with controlled_responses(requests_get, server):
+        with pytest.raises(Exception):
+            get_merge_status(stash, ['missing', 'master'])
+
+
+def test_get_branches_merge_status_parallel(stash):
+    barrier = threading.Barrier(4, timeout=5)
+
+    def compare(request):
+        # Every comparison of both branches must be in flight together
+        barrier.wait()
+        return (200, {}, json.dumps({'size': 1}))
+
+    with controlled_responses([
+        get_page_request('repo1', ['b1', 'b2'])
+    ], server) as rsps:
+        for _ in range(4):
+            rsps.rsps.add_callback(
+                responses.GET,
+                'http://host/rest/api/1.0/projects/project/repos/repo1/'
+                'compare/changes/',
+                callback=compare)
+        status = get_merge_status(stash, ['master', 'develop'])
+        assert len(rsps.calls) == 5
+
+    assert status == [('b1', False), ('b2', False)]
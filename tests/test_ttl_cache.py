@@ -0,0 +1,42 @@
+from utils.ttl_cache import TTLCache
+
+
+def test_get_set():
+    cache = TTLCache(10, 60)
+    assert cache.get('key') is None
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    assert cache.stats == {'entries': 1, 'hits': 1, 'misses': 1}
+
+
+def test_expiration():
+    cache = TTLCache(10, 0)
+    cache.set('key', 'value')
+    assert cache.get('key') is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = TTLCache(2, 60)
+    cache.set('key1', 1)
+    cache.set('key2', 2)
+    # Access key1 so key2 becomes the least recently used entry
+    cache.get('key1')
+    cache.set('key3', 3)
+
+    assert cache.get('key1') == 1
+    assert cache.get('key2') is None
+    assert cache.get('key3') == 3
+
+
+def test_remove_clear():
+    cache = TTLCache(10, 60)
+    cache.set('key1', 1)
+    cache.set('key2', 2)
+    cache.remove('key1')
+    assert cache.get('key1') is None
+    assert cache.get('key2') == 2
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.stats == {'entries': 0, 'hits': 0, 'misses': 0}
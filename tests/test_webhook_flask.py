@@ -0,0 +1,79 @@
+import json
+
+import pytest
+from mock import MagicMock
+
+from webhook.flask_app import create_app
+
+PAYLOAD = {
+    'webhookEvent': 'jira:issue_updated',
+    'issue': {'key': 'JIRA-1'},
+    'changelog': {
+        'items': [
+            {'field': 'assignee', 'toString': 'User'},
+            {'field': 'status', 'toString': 'Closed'}
+        ]
+    }
+}
+
+
+@pytest.fixture
+def callback():
+    return MagicMock()
+
+
+@pytest.fixture
+def app(callback):
+    return create_app(callback, token='secret')
+
+
+def post(client, payload, token='secret'):
+    return client.post('/jira?token={}'.format(token),
+                       data=json.dumps(payload),
+                       content_type='application/json')
+
+
+def test_closed_issue(client, callback):
+    assert post(client, PAYLOAD).status_code == 204
+    callback.assert_called_once_with('JIRA-1')
+
+
+def test_other_status(client, callback):
+    payload = dict(PAYLOAD, changelog={
+        'items': [{'field': 'status', 'toString': 'In Progress'}]})
+
+    assert post(client, payload).status_code == 204
+    assert not callback.called
+
+
+def test_other_event(client, callback):
+    payload = dict(PAYLOAD, webhookEvent='jira:issue_created')
+
+    assert post(client, payload).status_code == 204
+    assert not callback.called
+
+
+def test_invalid_token(client, callback):
+    assert post(client, PAYLOAD, token='invalid').status_code == 403
+    assert not callback.called
+
+
+def test_invalid_payload(client, callback):
+    response = client.post('/jira?token=secret', data='invalid')
+
+    assert response.status_code == 400
+    assert not callback.called
+
+
+def test_missing_token(client, callback):
+    response = client.post('/jira', data=json.dumps(PAYLOAD),
+                           content_type='application/json')
+
+    assert response.status_code == 403
+    assert not callback.called
+
+
+@pytest.mark.parametrize('token', [None, ''])
+def test_empty_token(callback, token):
+    with pytest.raises(ValueError):
+        create_app(callback, token)
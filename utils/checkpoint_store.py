@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CheckpointStore(object):
+    """Last issue seen by each notifier, persisted to a JSON file
+
+    The whole file is rewritten atomically on each update so a crash never
+    leaves a partial checkpoint. Without path, checkpoints are only kept in
+    memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__checkpoints = self.__load()
+
+    def get(self, name):
+        with self.__lock:
+            return self.__checkpoints.get(name)
+
+    def set(self, name, updated, key):
+        with self.__lock:
+            self.__checkpoints[name] = {'updated': updated, 'key': key}
+            if self.path is not None:
+                self.__save()
+
+    def __load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as ex:
+            logger.error('Unable to load checkpoints: %s', ex)
+            return {}
+
+    def __save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temppath = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.__checkpoints, f)
+            os.replace(temppath, self.path)
+        except OSError:
+            os.remove(temppath)
+            raise
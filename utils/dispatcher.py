@@ -0,0 +1,127 @@
+import functools
+import logging
+import queue
+import threading
+import time
+
+from slackbot.dispatcher import Message
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_AGE = 60  # seconds
+
+__dispatchers = {}
+__dispatchers_lock = threading.Lock()
+
+
+class Dispatcher(object):
+    """Run plugin handlers on their own bounded pool of worker threads
+
+    When the queue is full new messages are rejected instead of blocking
+    the slackbot dispatcher. Messages waiting longer than max_age seconds
+    are dropped as the answer would not be relevant anymore. Users are
+    told when their message is dropped or when its handler fails.
+    """
+
+    def __init__(self, name, workers=DEFAULT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE, max_age=DEFAULT_MAX_AGE):
+        self.name = name
+        self.max_age = max_age
+        self.rejected = 0
+        self.expired = 0
+        self.__stats_lock = threading.Lock()
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__workers = [
+            threading.Thread(target=self.__work,
+                             name='{}-{}'.format(name, index),
+                             daemon=True)
+            for index in range(workers)]
+        for worker in self.__workers:
+            worker.start()
+
+    def __len__(self):
+        return self.__queue.qsize()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue function call and return False if queue is full"""
+        try:
+            self.__queue.put_nowait(
+                (time.monotonic(), function, args, kwargs))
+        except queue.Full:
+            with self.__stats_lock:
+                self.rejected += 1
+            logger.warning('%s queue is full, message dropped', self.name)
+            self.__reply(args, 'Too many requests, please try again later')
+            return False
+
+        return True
+
+    def join(self):
+        """Wait until all queued calls are done"""
+        self.__queue.join()
+
+    def __work(self):
+        while True:
+            queued, function, args, kwargs = self.__queue.get()
+            try:
+                age = time.monotonic() - queued
+                if age > self.max_age:
+                    with self.__stats_lock:
+                        self.expired += 1
+                    logger.warning('%s message dropped after waiting %.1fs',
+                                   self.name, age)
+                    self.__reply(args, 'Too busy to handle your request, '
+                                       'please try again later')
+                    continue
+
+                function(*args, **kwargs)
+            except Exception as ex:
+                logger.error('%s handler failed: %s', self.name, ex,
+                             exc_info=True)
+                self.__reply(args, '[{}] I had a problem handling your '
+                                   'message'.format(function.__name__))
+            finally:
+                self.__queue.task_done()
+
+    def __reply(self, args, text):
+        # Handlers of slackbot messages receive the message first
+        if args and isinstance(args[0], Message):
+            try:
+                args[0].reply(text)
+            except Exception as ex:
+                logger.error('%s unable to reply: %s', self.name, ex)
+
+
+def get_dispatcher(name, config=None, **kwargs):
+    """Return the dispatcher of a plugin, created on first use"""
+    with __dispatchers_lock:
+        dispatcher = __dispatchers.get(name)
+        if dispatcher is None:
+            if config is None:
+                config = {}
+            options = {
+                'workers': config.get('workers', DEFAULT_WORKERS),
+                'queue_size': config.get('queue_size', DEFAULT_QUEUE_SIZE),
+                'max_age': config.get('max_age', DEFAULT_MAX_AGE)
+            }
+            options.update(kwargs)
+            dispatcher = Dispatcher(name, **options)
+            __dispatchers[name] = dispatcher
+
+    return dispatcher
+
+
+def dispatched(name, config=None, **kwargs):
+    """Decorate a slackbot handler to run it on the plugin dispatcher"""
+    def decorator(function):
+        dispatcher = get_dispatcher(name, config, **kwargs)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            dispatcher.submit(function, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,22 +1,171 @@
+import hashlib
+import logging
+import re
+import threading
+import time
 import requests
 from base64 import b64encode, b64decode
 
+from utils.metrics import instrument
+from utils.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+ICONS_CACHE_SIZE = 256
+ICONS_CACHE_RETENTION = 60 * 60
+# Icons are kept longer than their retention delay so that expired entries
+# can be revalidated with a conditional request
+ICONS_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# Icons are registered again after this delay as the proxy cache may have
+# evicted them or been lost on redeployment
+REGISTRATION_RETENTION = 60 * 60
+# Failed registrations are not retried on each render during this delay
+REGISTRATION_FAILURE_RETENTION = 5 * 60
+REQUEST_TIMEOUT = 10
+CACHEKEY_REGEX = re.compile(r'^[0-9a-f]{64}$')
+
+__registered = TTLCache(ICONS_CACHE_SIZE, REGISTRATION_RETENTION)
+__failed_registrations = TTLCache(ICONS_CACHE_SIZE,
+                                  REGISTRATION_FAILURE_RETENTION)
+
+__icons = TTLCache(ICONS_CACHE_SIZE, ICONS_CACHE_MAX_AGE)
+__icons_stats = {'hits': 0, 'revalidations': 0, 'misses': 0}
+__icons_stats_lock = threading.Lock()
+
+__session = instrument(requests.Session(), 'icons', REQUEST_TIMEOUT)
+
+
+def convert_proxyurl(server, url, upload=False, token=None):
+    icon = __get_icon(url)
+    if icon is not None:
+        content_type = icon['content_type']
+        content = icon['content']
+
+        if upload:
+            proxyurl = __register(server, content_type, content, token)
+            if proxyurl is not None:
+                return proxyurl
 
-def convert_proxyurl(server, url):
-    icon_request = requests.get(url)
-    if icon_request.status_code == requests.codes.ok:
-        content_type = icon_request.headers.get('Content-Type')
         content_type = __encode(content_type.encode())
-        content = __encode(icon_request.content)
+        content = __encode(content)
 
         return '%s/image/%s/%s' % (server, content_type, content)
 
     return url
 
 
+def get_icons_cache_stats():
+    with __icons_stats_lock:
+        stats = dict(__icons_stats)
+
+    total = stats['hits'] + stats['revalidations'] + stats['misses']
+    hits = stats['hits'] + stats['revalidations']
+    stats['hit_ratio'] = float(hits) / total if total else 0.0
+    return stats
+
+
+def clear_icons_cache():
+    __icons.clear()
+    with __icons_stats_lock:
+        for key in __icons_stats:
+            __icons_stats[key] = 0
+
+
 def decode(content):
     return b64decode(content.encode(), altchars='-_')
 
 
+def content_hash(content_type, content):
+    sha = hashlib.sha256(content_type.encode())
+    sha.update(b'\n')
+    sha.update(content)
+    return sha.hexdigest()
+
+
+def __get_icon(url):
+    icon = __icons.get(url)
+    if icon is not None and icon['expiration'] > time.monotonic():
+        __count_icon('hits')
+        return icon
+
+    headers = {}
+    if icon is not None:
+        if icon['etag']:
+            headers['If-None-Match'] = icon['etag']
+        if icon['last_modified']:
+            headers['If-Modified-Since'] = icon['last_modified']
+
+    icon_request = __session.get(url, headers=headers)
+    if icon is not None and \
+            icon_request.status_code == requests.codes.not_modified:
+        __count_icon('revalidations')
+    elif icon_request.status_code == requests.codes.ok:
+        __count_icon('misses')
+        icon = {
+            'content_type': icon_request.headers.get('Content-Type'),
+            'content': icon_request.content,
+            'etag': icon_request.headers.get('ETag'),
+            'last_modified': icon_request.headers.get('Last-Modified')
+        }
+    else:
+        __count_icon('misses')
+        return None
+
+    icon['expiration'] = time.monotonic() + ICONS_CACHE_RETENTION
+    __icons.set(url, icon)
+    return icon
+
+
+def __count_icon(name):
+    with __icons_stats_lock:
+        __icons_stats[name] += 1
+
+
+def __register(server, content_type, content, token=None):
+    registration = (server, content_hash(content_type, content))
+    proxyurl = __registered.get(registration)
+    if proxyurl is not None:
+        return proxyurl
+
+    if __failed_registrations.get(registration) is not None:
+        return None
+
+    proxyurl = __upload(server, content_type, content, token)
+    if proxyurl is None:
+        __failed_registrations.set(registration, True)
+        return None
+
+    __registered.set(registration, proxyurl)
+    return proxyurl
+
+
+def __upload(server, content_type, content, token=None):
+    headers = {'Content-Type': content_type}
+    if token:
+        headers['Authorization'] = 'Bearer %s' % token
+
+    try:
+        request = __session.post(
+            '%s/upload' % server,
+            data=content,
+            headers=headers)
+    except requests.exceptions.RequestException as ex:
+        logger.warning('Unable to register icon on image proxy: %s', ex)
+        return None
+
+    if request.status_code != requests.codes.created:
+        logger.warning('Unable to register icon on image proxy: %s',
+                       request.status_code)
+        return None
+
+    # The proxy computes the key from the content type it received
+    key = request.text.strip()
+    if not CACHEKEY_REGEX.match(key):
+        logger.warning('Invalid key returned by image proxy: %r', key)
+        return None
+
+    return '%s/image/%s' % (server, key)
+
+
 def __encode(content):
     return b64encode(content, altchars=b'-_').decode()
@@ -0,0 +1,100 @@
+import re
+import threading
+from functools import lru_cache
+
+MATCH_CACHE_SIZE = 256
+
+# Cheap pattern used to dispatch messages which may contain a key
+TRIGGER_PATTERN = r'-\d'
+
+_TERMINAL = object()
+_SUFFIX_REGEX = re.compile(r'-\d+')
+
+
+class KeyMatcher(object):
+    """Find keys like PREFIX-123 of several plugins in a single pass
+
+    Prefixes of all registered plugins are stored in one trie. Text is
+    scanned once for dashes followed by digits and the trie is only walked
+    backward from those suffixes. Like the plugins regexes, keys must be
+    delimited by non word characters and prefixes are case insensitive.
+    Results are memoized per text as several plugins receive the same
+    message.
+    """
+
+    def __init__(self, cache_size=MATCH_CACHE_SIZE):
+        self.__groups = {}
+        self.__trie = {}
+        self.__lock = threading.Lock()
+        self.__scan = lru_cache(maxsize=cache_size)(self.__scan_text)
+
+    def register(self, name, prefixes, ignored_before=()):
+        """Register prefixes of a plugin, replacing previous ones
+
+        Keys preceded by one of the ignored_before words and a whitespace
+        are not returned for this plugin.
+        """
+        with self.__lock:
+            self.__groups[name] = (
+                list(prefixes),
+                tuple(x.upper() for x in ignored_before))
+            self.__trie = self.__build_trie()
+            self.__scan.cache_clear()
+
+    def findall(self, name, text):
+        return list(self.__scan(text).get(name, ()))
+
+    def __build_trie(self):
+        # Prefixes are stored reversed as they are read backward from the
+        # dash of each key
+        trie = {}
+        for name, (prefixes, _) in self.__groups.items():
+            for prefix in prefixes:
+                node = trie
+                for char in reversed(prefix.upper()):
+                    node = node.setdefault(char, {})
+                node.setdefault(_TERMINAL, []).append(name)
+        return trie
+
+    def __scan_text(self, text):
+        trie = self.__trie
+        matches = {}
+        length = len(text)
+        for suffix in _SUFFIX_REGEX.finditer(text):
+            dash, end = suffix.span()
+            if end < length and _is_word(text[end]):
+                continue
+
+            node = trie
+            start = dash
+            while start > 0:
+                node = node.get(text[start - 1].upper())
+                if node is None:
+                    break
+                start -= 1
+
+                if _TERMINAL in node and \
+                        (start == 0 or not _is_word(text[start - 1])):
+                    for name in node[_TERMINAL]:
+                        if not self.__is_ignored(name, text, start):
+                            matches.setdefault(name, []).append(
+                                text[start:end])
+
+        return {name: tuple(keys) for name, keys in matches.items()}
+
+    def __is_ignored(self, name, text, start):
+        ignored_before = self.__groups[name][1]
+        if not ignored_before or start == 0 or \
+                not text[start - 1].isspace():
+            return False
+
+        before = text[max(0, start - 1 - max(map(len, ignored_before))):
+                      start - 1].upper()
+        return before.endswith(ignored_before)
+
+
+def _is_word(char):
+    return char.isalnum() or char == '_'
+
+
+shared_matcher = KeyMatcher()
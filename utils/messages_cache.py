@@ -1,21 +1,96 @@
-from datetime import datetime, timedelta
-
-CACHE_RETENTION_DELAY = 30
-
-
-class MessagesCache:
-    def __init__(self):
-        self.cache = {}
-
-    def AddToCache(self, key):
-        self.cache[key] = datetime.utcnow()
-
-    def IsInCache(self, key):
-        self.CleanCache()
-        return key in self.cache
-
-    def CleanCache(self):
-        for key, value in list(self.cache.items()):
-            delta = timedelta(seconds=CACHE_RETENTION_DELAY)
-            if value + delta < datetime.utcnow():
-                del self.cache[key]
+import threading
+import time
+from collections import deque
+
+CACHE_RETENTION_DELAY = 30
+CACHE_MAX_ENTRIES = 10000
+CACHE_STRIPES = 16
+
+
+class MessagesCache:
+    def __init__(self, retention_delay=CACHE_RETENTION_DELAY,
+                 max_entries=CACHE_MAX_ENTRIES, stripes=CACHE_STRIPES):
+        # Keys are spread over several independently locked stripes so
+        # concurrent handlers rarely wait on each other
+        stripe_max_entries = max(1, -(-max_entries // stripes))
+        self.__stripes = [
+            _CacheStripe(retention_delay, stripe_max_entries)
+            for _ in range(stripes)]
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self.__stripes)
+
+    def add_if_absent(self, key):
+        """Add key to cache and return True if it was not already cached"""
+        return self.__get_stripe(key).add_if_absent(key)
+
+    def AddToCache(self, key):
+        self.__get_stripe(key).add(key)
+
+    def IsInCache(self, key):
+        return self.__get_stripe(key).contains(key)
+
+    def CleanCache(self):
+        for stripe in self.__stripes:
+            stripe.clean()
+
+    def __get_stripe(self, key):
+        return self.__stripes[hash(key) % len(self.__stripes)]
+
+
+class _CacheStripe:
+    def __init__(self, retention_delay, max_entries):
+        self.retention_delay = retention_delay
+        self.max_entries = max_entries
+        self.__entries = {}
+        self.__expirations = deque()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        with self.__lock:
+            self.__expire(time.monotonic())
+            return len(self.__entries)
+
+    def add_if_absent(self, key):
+        with self.__lock:
+            now = time.monotonic()
+            self.__expire(now)
+            if key in self.__entries:
+                return False
+
+            self.__add(key, now)
+            return True
+
+    def add(self, key):
+        with self.__lock:
+            now = time.monotonic()
+            self.__expire(now)
+            self.__add(key, now)
+
+    def contains(self, key):
+        with self.__lock:
+            self.__expire(time.monotonic())
+            return key in self.__entries
+
+    def clean(self):
+        with self.__lock:
+            self.__expire(time.monotonic())
+
+    def __add(self, key, now):
+        expiration = now + self.retention_delay
+        self.__entries[key] = expiration
+        self.__expirations.append((expiration, key))
+        while len(self.__entries) > self.max_entries:
+            self.__pop_oldest()
+
+    def __expire(self, now):
+        # Entries are appended in expiration order so only the oldest ones
+        # need to be checked
+        while self.__expirations and self.__expirations[0][0] <= now:
+            self.__pop_oldest()
+
+    def __pop_oldest(self):
+        expiration, key = self.__expirations.popleft()
+        # Key may have been added again since this entry was queued
+        if self.__entries.get(key) == expiration:
+            del self.__entries[key]
@@ -0,0 +1,231 @@
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RETRYABLE_STATUS = ('502', '503', '504', 'error')
+MAX_ENDPOINTS = 500
+OTHER_ENDPOINT = 'other'
+
+# Keys (JIRA-1, CRUA-1), Bamboo plan keys (BAMA-DEV) and numeric ids, API
+# versions like /2/ are kept
+ID_SEGMENT_REGEX = re.compile(
+    r'(?<=/)(?:[A-Za-z]\w*-\d+|\d{2,})(?=/|$)'
+    r'|(?<=/plan/)[A-Za-z][A-Za-z0-9]*-[A-Za-z0-9]+(?=/|$)')
+
+
+class Metrics(object):
+    """Count requests sent to each backend endpoint
+
+    Requests are grouped by backend, method and endpoint. Path segments
+    holding keys or ids are replaced by {id} so the number of endpoints
+    stays bounded. Endpoints beyond max_endpoints are counted as other.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, max_endpoints=MAX_ENDPOINTS):
+        self.buckets = buckets
+        self.max_endpoints = max_endpoints
+        self.__lock = threading.Lock()
+        self.__endpoints = {}
+        self.__last_failures = threading.local()
+
+    def observe(self, backend, method, url, status, duration):
+        endpoint = get_endpoint(url)
+        status = str(status)
+        key = (backend, method, endpoint)
+
+        # A request sent again after a retryable failure on the same URL
+        # by the same thread is counted as a retry
+        last_failure = getattr(self.__last_failures, 'value', None)
+        retry = last_failure == (backend, method, url)
+        self.__last_failures.value = \
+            (backend, method, url) if status in RETRYABLE_STATUS else None
+
+        with self.__lock:
+            stats = self.__endpoints.get(key)
+            if stats is None and \
+                    len(self.__endpoints) >= self.max_endpoints:
+                key = (backend, method, OTHER_ENDPOINT)
+                stats = self.__endpoints.get(key)
+            if stats is None:
+                stats = _EndpointStats(len(self.buckets))
+                self.__endpoints[key] = stats
+
+            stats.count += 1
+            stats.retries += retry
+            stats.duration += duration
+            stats.statuses[status] += 1
+            for index, bucket in enumerate(self.buckets):
+                if duration <= bucket:
+                    stats.buckets[index] += 1
+                    break
+
+    def get_stats(self):
+        """Return stats of each (backend, method, endpoint)"""
+        with self.__lock:
+            return {key: {
+                'count': stats.count,
+                'retries': stats.retries,
+                'duration': stats.duration,
+                'statuses': dict(stats.statuses),
+                'buckets': list(zip(self.buckets, stats.buckets))
+            } for key, stats in self.__endpoints.items()}
+
+    def reset(self):
+        with self.__lock:
+            self.__endpoints.clear()
+
+    def to_prometheus(self):
+        lines = [
+            '# TYPE atlassianbot_requests_total counter',
+            '# TYPE atlassianbot_request_retries_total counter',
+            '# TYPE atlassianbot_request_duration_seconds histogram'
+        ]
+        for (backend, method, endpoint), stats in \
+                sorted(self.get_stats().items()):
+            labels = 'backend="{}",method="{}",endpoint="{}"'.format(
+                backend, method, endpoint)
+
+            for status, count in sorted(stats['statuses'].items()):
+                lines.append(
+                    'atlassianbot_requests_total{{{},status="{}"}} {}'.format(
+                        labels, status, count))
+            lines.append('atlassianbot_request_retries_total{{{}}} {}'.format(
+                labels, stats['retries']))
+
+            cumulative = 0
+            for bucket, count in stats['buckets']:
+                cumulative += count
+                lines.append(
+                    'atlassianbot_request_duration_seconds_bucket'
+                    '{{{},le="{}"}} {}'.format(labels, bucket, cumulative))
+            lines.append(
+                'atlassianbot_request_duration_seconds_bucket'
+                '{{{},le="+Inf"}} {}'.format(labels, stats['count']))
+            lines.append(
+                'atlassianbot_request_duration_seconds_sum{{{}}} {}'.format(
+                    labels, stats['duration']))
+            lines.append(
+                'atlassianbot_request_duration_seconds_count{{{}}} {}'.format(
+                    labels, stats['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        for (backend, method, endpoint), stats in \
+                sorted(self.get_stats().items()):
+            logger.info('%s %s %s: %d requests, %.3fs average, '
+                        'statuses %s, %d retries',
+                        backend, method, endpoint,
+                        stats['count'],
+                        stats['duration'] / stats['count'],
+                        stats['statuses'],
+                        stats['retries'])
+
+
+class _EndpointStats(object):
+    def __init__(self, buckets_count):
+        self.count = 0
+        self.retries = 0
+        self.duration = 0.0
+        self.statuses = defaultdict(int)
+        self.buckets = [0] * buckets_count
+
+
+class InstrumentedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter recording latency and status of each request
+
+    A default timeout is applied to requests sent without one.
+    """
+
+    def __init__(self, backend, timeout=None, registry=None, **kwargs):
+        self.backend = backend
+        self.timeout = timeout
+        self.registry = registry
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        start = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except Exception:
+            self.__observe(request, 'error', start)
+            raise
+
+        self.__observe(request, response.status_code, start)
+        return response
+
+    def __observe(self, request, status, start):
+        registry = self.registry if self.registry is not None else metrics
+        registry.observe(self.backend,
+                         request.method,
+                         request.url,
+                         status,
+                         time.monotonic() - start)
+
+
+def instrument(session, backend, timeout=None, **kwargs):
+    """Record metrics of all requests sent with session"""
+    adapter = InstrumentedHTTPAdapter(backend, timeout, **kwargs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_endpoint(url):
+    return ID_SEGMENT_REGEX.sub('{id}', urlsplit(url).path)
+
+
+def serve(port, host='0.0.0.0', registry=None):
+    """Serve metrics in Prometheus text format on /metrics"""
+    if registry is None:
+        registry = metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            content = registry.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def log_periodically(interval, registry=None):
+    """Log a summary of metrics every interval seconds"""
+    if registry is None:
+        registry = metrics
+
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            registry.log_summary()
+
+    threading.Thread(target=run, daemon=True).start()
+    return stopped
+
+
+metrics = Metrics()
@@ -1,8 +1,11 @@
 import abc
+import asyncio
 import inspect
 import json
 import logging
+import random
 import threading
+from collections import defaultdict, deque
 
 from concurrent.futures import ThreadPoolExecutor
 from slackbot.bot import Bot
@@ -10,30 +13,48 @@ from slackbot.bot import Bot
 logger = logging.getLogger(__name__)
 
 MAX_NOTIFIERS_WORKERS = 2
+MAX_BACKEND_CONCURRENCY = 2
+MAX_JITTER = 5  # seconds
+MAX_MESSAGE_ATTACHMENTS = 20
 
 
 class NotifierBot(object):
-    def __init__(self, slackclient=None):
+    def __init__(self, slackclient=None, config=None):
         logger.info('registered %s', self.__class__.__name__)
 
         if slackclient is None:
             slackclient = self.__get_slackclient()
         self.__slackclient = slackclient
+        self.executor = None
+        self.scheduler = None
 
         if self.__slackclient is None:
             logger.error('Unable to retrieve slackclient instance')
             return
 
-        self.executor = ThreadPoolExecutor(max_workers=MAX_NOTIFIERS_WORKERS)
+        if config is None:
+            config = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.get('max_workers', MAX_NOTIFIERS_WORKERS))
+        self.scheduler = NotifierScheduler(
+            self.executor,
+            max_backend_concurrency=config.get('max_in_flight',
+                                               MAX_BACKEND_CONCURRENCY))
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.scheduler is None:
+            return
+
+        self.scheduler.stop()
         self.executor.shutdown(wait=True)
+        self.scheduler.close()
 
     def submit(self, job):
-        job._init_threaded(self.executor, self.__slackclient)
+        if self.scheduler is not None:
+            job._init_threaded(self.scheduler, self.__slackclient)
 
     def __get_slackclient(self):
         stack = inspect.stack()
@@ -44,13 +65,133 @@ class NotifierBot(object):
                     return instance._client
 
 
+class NotifierScheduler(object):
+    """Run notifier jobs at a fixed cadence from a single event loop
+
+    Jobs are executed on the given executor. At most max_backend_concurrency
+    jobs sharing the same backend run at the same time, others wait for a
+    free slot. A job whose previous run is still waiting or in progress
+    skips its next runs instead of queuing them.
+    """
+
+    def __init__(self, executor,
+                 max_backend_concurrency=MAX_BACKEND_CONCURRENCY,
+                 max_jitter=MAX_JITTER):
+        self.__executor = executor
+        self.__max_backend_concurrency = max_backend_concurrency
+        self.__max_jitter = max_jitter
+        self.__running = defaultdict(int)
+        self.__waiting = defaultdict(deque)
+        self.__busy = set()
+        self.skipped = 0
+
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__run_loop, daemon=True)
+        self.__thread.start()
+
+    def schedule(self, job):
+        self.__loop.call_soon_threadsafe(self.__init_job, job)
+
+    def stop(self):
+        if self.__thread.is_alive():
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+
+    def close(self):
+        self.stop()
+        self.__loop.close()
+
+    def __run_loop(self):
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
+
+    def __init_job(self, job):
+        future = self.__run_in_executor(job._init)
+        if future is not None:
+            future.add_done_callback(lambda f: self.__schedule_first(job))
+
+    def __schedule_first(self, job):
+        # Random offset spreads jobs sharing the same polling interval
+        jitter = random.uniform(
+            0,
+            min(self.__max_jitter, job.polling_interval / 10.0))
+        self.__schedule(job,
+                        self.__loop.time() + job.polling_interval + jitter)
+
+    def __schedule(self, job, when):
+        job._next_run = when
+        self.__loop.call_at(when, self.__tick, job)
+
+    def __tick(self, job):
+        # Next run is computed from the planned time and not from the end of
+        # the previous run so jobs do not drift
+        planned = job._next_run
+        when = planned + job.polling_interval
+        now = self.__loop.time()
+        while when <= now:
+            when += job.polling_interval
+        self.__schedule(job, when)
+
+        if job in self.__busy:
+            self.skipped += 1
+            logger.warning('Skipping run of %s on channel \'%s\', previous '
+                           'run still in progress',
+                           job.__class__.__name__, job.channel)
+            return
+
+        self.__busy.add(job)
+        self.__acquire(job, planned)
+
+    def __acquire(self, job, planned):
+        backend = job.backend
+        if self.__running[backend] < self.__max_backend_concurrency:
+            self.__running[backend] += 1
+            self.__execute(job, planned)
+        else:
+            self.__waiting[backend].append((job, planned))
+
+    def __execute(self, job, planned):
+        logger.debug('Running %s on channel \'%s\': lag %.3fs, '
+                     '%d running and %d waiting on backend \'%s\'',
+                     job.__class__.__name__, job.channel,
+                     self.__loop.time() - planned,
+                     self.__running[job.backend],
+                     len(self.__waiting[job.backend]),
+                     job.backend)
+
+        future = self.__run_in_executor(job._run)
+        if future is None:
+            self.__release(job)
+        else:
+            future.add_done_callback(lambda f: self.__release(job))
+
+    def __release(self, job):
+        backend = job.backend
+        self.__busy.discard(job)
+        self.__running[backend] -= 1
+        if self.__waiting[backend]:
+            self.__acquire(*self.__waiting[backend].popleft())
+
+    def __run_in_executor(self, fn):
+        try:
+            return self.__loop.run_in_executor(self.__executor, fn)
+        except RuntimeError as ex:
+            logger.warn('Unable to run task: %s', ex, exc_info=True)
+
+
 class NotifierJob(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, channel, polling_interval):
+    def __init__(self, channel, polling_interval, backend=None):
         self.channel = channel
         self.polling_interval = polling_interval
+        self.backend = backend
         self.run_callback = None
+        self.__channel_id = None
+
+    @property
+    def bound(self):
+        return self.__channel_id is not None
 
     def _init(self):
         try:
@@ -67,28 +208,18 @@ class NotifierJob(object):
         except Exception as ex:
             logger.error('Unable to run notifier job: %s', ex, exc_info=True)
 
-    def __run_async(self, fn):
-        threading.Timer(self.polling_interval, self._run_in_executor).start()
+    def _init_threaded(self, scheduler, slackclient):
+        if self._bind(slackclient):
+            scheduler.schedule(self)
 
-    def _run_in_executor(self):
-        try:
-            self.__executor \
-                .submit(self._run) \
-                .add_done_callback(self.__run_async)
-        except RuntimeError as ex:
-            logger.warn('Unable to run task: %s', ex, exc_info=True)
-
-    def _init_threaded(self, executor, slackclient):
-        self.__executor = executor
+    def _bind(self, slackclient):
         self.__slackclient = slackclient
         self.__channel_id = self.__get_channel(self.channel)
         if self.__channel_id is None:
             logger.error('Unable to find channel')
-            return
+            return False
 
-        self.__executor \
-            .submit(self._init) \
-            .add_done_callback(self.__run_async)
+        return True
 
     def __get_channel(self, channelname):
         for id, channel in list(self.__slackclient.channels.items()):
@@ -104,7 +235,10 @@ class NotifierJob(object):
         """Method that should do something."""
 
     def send_message(self, attachments):
-        self.__slackclient.send_message(
-                self.__channel_id,
-                '',
-                attachments=json.dumps(attachments))
+        # Slack truncates messages with too many attachments
+        for index in range(0, len(attachments), MAX_MESSAGE_ATTACHMENTS):
+            self.__slackclient.send_message(
+                    self.__channel_id,
+                    '',
+                    attachments=json.dumps(
+                        attachments[index:index + MAX_MESSAGE_ATTACHMENTS]))
@@ -1,49 +1,115 @@
 import json
+import threading
+from urllib.parse import urlsplit
 import requests
 import plugins.settings as settings
+from utils.metrics import instrument
 
 headers = {'accept': 'application/json'}
 
+DEFAULT_POOL_SIZE = 10
+
+__sessions = {}
+__sessions_lock = threading.Lock()
 
-def get(config, path, data=None):
-    auth = None
-    if 'username' in config and 'password' in config:
-        auth = (config['username'], config['password'])
 
-    request = requests.get(
+def get_backend(config):
+    return urlsplit(config['host']).netloc
+
+
+def get(config, path, data=None):
+    request = __get_session(config).get(
         url=__format_url(config, path),
         params=data,
-        headers=headers,
-        auth=auth,
-        verify=settings.servers.verify_ssl)
+        headers=headers)
 
     return request
 
 
 def delete(config, path, data):
-    request = requests.delete(
+    request = __get_session(config).delete(
         url=__format_url(config, path),
         data=json.dumps(data),
         headers={
             'Content-type': 'application/json',
             'Accept': 'application/json'
-        },
-        auth=(config['username'], config['password']),
-        verify=settings.servers.verify_ssl)
+        })
 
     return request
 
 
 def post(config, path, data=None):
-    request = requests.post(
+    request = __get_session(config).post(
         url=__format_url(config, path),
         data=data,
-        headers=headers,
-        auth=(config['username'], config['password']),
-        verify=settings.servers.verify_ssl)
+        headers=headers)
 
     return request
 
 
+def get_pool_stats():
+    """Return connections opened and reused for each server session"""
+    stats = {}
+    with __sessions_lock:
+        sessions = list(__sessions.items())
+
+    for (host, _), session in sessions:
+        opened = 0
+        requests_count = 0
+        # The same adapter is mounted for http:// and https://
+        adapters = {id(x): x for x in session.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    requests_count += pool.num_requests
+
+        server_stats = stats.setdefault(host, {'opened': 0, 'reused': 0})
+        server_stats['opened'] += opened
+        server_stats['reused'] += max(requests_count - opened, 0)
+
+    return stats
+
+
+def close_sessions():
+    with __sessions_lock:
+        sessions = list(__sessions.values())
+        __sessions.clear()
+
+    for session in sessions:
+        session.close()
+
+
+def __get_session(config):
+    key = (config['host'], config.get('username'))
+    session = __sessions.get(key)
+    if session is None:
+        with __sessions_lock:
+            session = __sessions.get(key)
+            if session is None:
+                session = __create_session(config)
+                __sessions[key] = session
+
+    return session
+
+
+def __create_session(config):
+    pool_size = config.get('pool_size', DEFAULT_POOL_SIZE)
+
+    session = requests.Session()
+    instrument(session,
+               get_backend(config),
+               pool_connections=1,
+               pool_maxsize=pool_size)
+    session.headers['Connection'] = 'keep-alive'
+    session.verify = settings.servers.verify_ssl
+    if 'username' in config and 'password' in config:
+        session.auth = (config['username'], config['password'])
+
+    return session
+
+
 def __format_url(config, path):
     return '{server}{path}'.format(server=config['host'], path=path)
@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Bounded LRU cache whose entries expire after a retention delay"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                expiration, value = entry
+                if expiration > time.monotonic():
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.__entries[key]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def remove(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return {
+                'entries': len(self.__entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,49 @@
+import hmac
+
+from flask import Flask, request, abort
+
+ISSUE_UPDATED_EVENT = 'jira:issue_updated'
+CLOSED_STATUS = 'Closed'
+
+
+def create_app(callback, token):
+    """Create an app calling callback with the key of each closed issue
+
+    Jira must be configured to send issue updated webhooks to /jira with the
+    given token in the token query parameter.
+    """
+    if not token:
+        raise ValueError('A webhook token is required')
+
+    app = Flask(__name__)
+    app.debug = False
+    app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+
+    @app.route('/jira', methods=['POST'])
+    def jira():
+        if not hmac.compare_digest(request.args.get('token', '').encode(),
+                                   token.encode()):
+            abort(403)
+
+        payload = request.get_json(force=True, silent=True)
+        if not isinstance(payload, dict):
+            abort(400)
+
+        key = get_closed_issue_key(payload)
+        if key is not None:
+            callback(key)
+
+        return '', 204
+
+    return app
+
+
+def get_closed_issue_key(payload):
+    if payload.get('webhookEvent') != ISSUE_UPDATED_EVENT:
+        return None
+
+    items = (payload.get('changelog') or {}).get('items') or []
+    for item in items:
+        if item.get('field') == 'status' and \
+                item.get('toString') == CLOSED_STATUS:
+            return (payload.get('issue') or {}).get('key')